@@ -1,128 +1,458 @@
+import ast, bisect, contextlib, filecmp, hashlib, itertools, json, mmap, operator, os, re, struct, threading
+
+from fileio import atomicFile, removeTemp, tempName
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 
 def round_up(x, y):
     return ((x - 1) | (y - 1)) + 1
 
-symbols = {}
-diffs = []
+_operators = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.LShift: operator.lshift, ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_, ast.BitAnd: operator.and_,
+}
 
-def parseAddrFile(lines):
-    global text, data, textAddr, dataAddr
-    for line in lines:
-        line = line.strip().replace(' ', '')
+def parseNumber(text):
+    # Integer literals combined with simple arithmetic, e.g. "0x10", "+0x40" or "-(0x100 + 8)"
+    try:
+        return int(text, 0)
+    except ValueError:
+        pass
 
-        if not line or line.startswith('#'):
-            pass
+    def evaluate(node):
+        if isinstance(node, ast.Constant) and type(node.value) is int:
+            return node.value
+
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, (ast.UAdd, ast.USub)):
+            value = evaluate(node.operand)
+            return -value if isinstance(node.op, ast.USub) else value
+
+        if isinstance(node, ast.BinOp) and type(node.op) in _operators:
+            return _operators[type(node.op)](evaluate(node.left), evaluate(node.right))
+
+        raise ValueError("Invalid number: '%s'" %text)
+
+    try:
+        tree = ast.parse(text.strip(), mode='eval')
+    except SyntaxError:
+        raise ValueError("Invalid number: '%s'" %text) from None
+
+    return evaluate(tree.body)
+
+class AddressMap:
+    # Contents of an addr_<region>.txt file
+    # Saved in a binary cache, keyed by the hash of the text file
+
+    MAGIC = b'CLAM'
+    VERSION = 1
+
+    headerStruct = struct.Struct('>4sH2x32sqqII')  # Magic, version, key, text, data, symbol count, range count
+    diffStruct = struct.Struct('>QQq')
+    symbolStruct = struct.Struct('>qH')  # Value, name length, followed by the name
+
+    def __init__(self, text=0, data=0, symbols=None, diffs=None):
+        self.text = text
+        self.data = data
+        self.symbols = symbols if symbols is not None else {}
+        self.diffs = diffs if diffs is not None else []  # Sorted (start, end, diff) ranges
+
+    @classmethod
+    def parse(cls, lines):
+        addressMap = cls()
+        for line in lines:
+            line = line.strip().replace(' ', '')
+
+            if not line or line.startswith('#'):
+                pass
+
+            elif line.startswith('text='): addressMap.text = parseNumber(line.split('text=')[1])
+            elif line.startswith('data='): addressMap.data = parseNumber(line.split('data=')[1])
+
+            elif line.startswith('-'):
+                symentry = line.split('=')
+                symbol, address = symentry[0][1:], parseNumber(symentry[1])
+                addressMap.symbols[symbol] = address
+
+            else:
+                old, new = line.split(':Addr')
+                starthex, endhex = old.split('-')
+                start = int(starthex, 16)
+                end = int(endhex, 16)
+                diff = parseNumber(new)
+                addressMap.diffs.append((start, end, diff))
+
+        addressMap.symbols['textAddr'] = round_up(addressMap.symbols['textAddr'], 32)
+        addressMap.symbols['dataAddr'] = round_up(addressMap.symbols['dataAddr'] + 4, 32)
+        assert addressMap.symbols['textAddr'] < addressMap.symbols['dataAddr']
+
+        addressMap.checkDiffs()
+        return addressMap
+
+    def checkDiffs(self):
+        # Ranges are sorted so addresses can be looked up with a binary search
+        self.diffs.sort()
+        for i, (start, end, diff) in enumerate(self.diffs):
+            if start >= end:
+                raise ValueError("Empty address range: 0x%x-0x%x" %(start, end))
+
+            if i and start < self.diffs[i - 1][1]:
+                raise ValueError("Overlapping address ranges: 0x%x-0x%x and 0x%x-0x%x" %(self.diffs[i - 1][:2] + (start, end)))
+
+    def save(self, filename, key):
+        out = bytearray(self.headerStruct.pack(self.MAGIC, self.VERSION, key, self.text, self.data, len(self.symbols), len(self.diffs)))
+        for diff in self.diffs:
+            out += self.diffStruct.pack(*diff)
+
+        for name, value in self.symbols.items():
+            rawname = name.encode()
+            out += self.symbolStruct.pack(value, len(rawname))
+            out += rawname
 
-        elif line.startswith('text='): text = eval(line.split('text=')[1])
-        elif line.startswith('data='): data = eval(line.split('data=')[1])
-        
-        elif line.startswith('-'):
-            symentry = line.split('=')
-            symbol, address = symentry[0][1:], eval(symentry[1])
-            symbols[symbol] = address
+        with atomicFile(filename) as f:
+            f.write(out)
 
+    @classmethod
+    def load(cls, filename, key):
+        # Returns None if the cache is missing, unreadable or for another version of the text file
+        try:
+            with open(filename, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        except (OSError, ValueError):
+            return None
+
+        with data:
+            try:
+                magic, version, cachedKey, text, data_, symbolCount, diffCount = cls.headerStruct.unpack_from(data, 0)
+                if magic != cls.MAGIC or version != cls.VERSION or cachedKey != key:
+                    return None
+
+                pos = cls.headerStruct.size
+                diffs = list(cls.diffStruct.iter_unpack(data[pos:pos + diffCount * cls.diffStruct.size]))
+                pos += diffCount * cls.diffStruct.size
+
+                symbols = {}
+                for i in range(symbolCount):
+                    value, length = cls.symbolStruct.unpack_from(data, pos)
+                    pos += cls.symbolStruct.size
+                    symbols[data[pos:pos + length].decode()] = value
+                    pos += length
+
+            except (struct.error, UnicodeDecodeError):
+                return None
+
+        return cls(text, data_, symbols, diffs)
+
+class AddrConverter:
+    def __init__(self, region, filename=None, addressMap=None, key=None):
+        self.region = region
+        self.filename = filename
+        self.key = key  # Hash of the address file
+        self.setMap(addressMap or AddressMap())
+
+    def setMap(self, addressMap):
+        self.map = addressMap
+        self.text = addressMap.text
+        self.data = addressMap.data
+        self.symbols = addressMap.symbols
+        self.diffs = addressMap.diffs
+
+        self.starts = [diff[0] for diff in self.diffs]
+        self.ends = [diff[1] for diff in self.diffs]
+        self.arrays = None
+        self.tables = {}  # Converted symbol map caches, which depend on the map
+
+    def parseAddrFile(self, lines):
+        self.setMap(AddressMap.parse(lines))
+
+    def convert(self, address, fixWriteProtection=False):
+        if address < 0x10000000:
+            segment = self.text
+        else:
+            segment = self.data
+
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0 and address < self.ends[i]:
+            return address + self.diffs[i][2] + segment
+
+        raise ValueError("Invalid or unimplemented address: 0x%x" %address)
+
+    def convertMany(self, addresses, strict=True):
+        # Converts a list of addresses at once
+        # Invalid addresses raise a ValueError, or are returned as None if not strict
+        if numpy is not None and len(addresses) > 256:
+            return self.convertArray(addresses, strict)
+
+        converted = []
+        for address in addresses:
+            try:
+                converted.append(self.convert(address))
+            except ValueError:
+                if strict:
+                    raise
+                converted.append(None)
+
+        return converted
+
+    def convertArray(self, addresses, strict):
+        if self.arrays is None:
+            self.arrays = (
+                numpy.array(self.starts, dtype=numpy.int64),
+                numpy.array(self.ends, dtype=numpy.int64),
+                numpy.array([diff[2] for diff in self.diffs], dtype=numpy.int64),
+            )
+
+        starts, ends, diffs = self.arrays
+        addresses = numpy.asarray(addresses, dtype=numpy.int64)
+
+        indices = numpy.searchsorted(starts, addresses, 'right') - 1
+        valid = indices >= 0
+        indices[~valid] = 0
+        if len(ends):
+            valid &= addresses < ends[indices]
+            converted = addresses + diffs[indices] + numpy.where(addresses < 0x10000000, self.text, self.data)
         else:
-            old, new = line.split(':Addr')
-            starthex, endhex = old.split('-')
-            start = int(starthex, 16)
-            end = int(endhex, 16)
-            diff = eval(new)
-            diffs.append((start, end, diff))
-
-    symbols['textAddr'] = round_up(symbols['textAddr'], 32)
-    symbols['dataAddr'] = round_up(symbols['dataAddr'] + 4, 32)
-    assert symbols['textAddr'] < symbols['dataAddr']
-
-def loadAddrFile(name):
-    global region
-    region = name
-    
-    symbols.clear()
-    del diffs[:]
-
-    with open('addr_%s.txt' %name) as f:
-        parseAddrFile(f.readlines())
-
-def convert(address, fixWriteProtection=False):
-    if address < 0x10000000:
-        segment = text
-    else:
-        segment = data
-
-    for diff in diffs:
-        if diff[0] <= address < diff[1]:
-            addr = address + diff[2] + segment
-            return addr
-
-    raise ValueError("Invalid or unimplemented address: 0x%x" %address)
-
-def removeCComments(file_str):
-    file_len = len(file_str)
-    res = bytearray()
-
-    # https://stackoverflow.com/a/2395019
-
-    pos = 0
-    while pos < file_len:
-        c = file_str[pos]
-        if c == '\'' or c == '"':
-            q = c
+            valid[:] = False
+            converted = addresses
+
+        if valid.all():
+            return converted.tolist()
+
+        if strict:
+            raise ValueError("Invalid or unimplemented address: 0x%x" %addresses[~valid][0])
+
+        return [int(address) if ok else None for address, ok in zip(converted, valid)]
+
+    def convertTable(self, table, newfile):
+        convertTables(table, [(self, newfile)])
+
+    def loadTableCache(self, cachefile):
+        # {line of the map: converted line}, only valid for the same address file
+        # Kept in memory once loaded, so watch builds do not read it again
+        cache = self.tables.pop(cachefile, None)
+        if cache is not None or self.key is None:
+            return cache or {}
+
+        try:
+            with open(cachefile) as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+        if cache.get('key') != self.key:
+            return {}
+
+        return cache.get('lines', {})
+
+    def saveTableCache(self, cachefile, entries, changed):
+        self.tables[cachefile] = entries
+        if self.key is None or not changed:
+            return
+
+        with atomicFile(cachefile, 'w') as f:
+            json.dump({'key': self.key, 'lines': entries}, f)
+
+class TableWriter:
+    # Converts a symbol map for one region, a chunk at a time, into a temporary file
+    def __init__(self, converter, newfile):
+        self.converter = converter
+        self.newfile = newfile
+
+        # Lines converted by the last run are reused, so only new or changed lines are parsed and converted again
+        # They are moved from the old cache to the new one, so stale entries are dropped along the way
+        self.cachefile = newfile + '.cache'
+        self.old = converter.loadTableCache(self.cachefile)
+        self.cache = {}
+        self.changed = False
+
+        self.temp = tempName(newfile)
+        self.file = open(self.temp, 'w')
+
+    def write(self, lines, symbols):
+        # symbols: {line: (name, address)} of the lines parsed for this chunk, shared by every region
+        todo = {}
+        for line in lines:
+            if line[-1:] == ';' and line not in self.cache:
+                newline = self.old.pop(line, None)
+                if newline is None:
+                    todo[line] = None
+                else:
+                    self.cache[line] = newline
+
+        if todo:
+            for line in todo:
+                if line not in symbols:
+                    symbols[line] = parseSymbol(line)
+
+            addrs = self.converter.convertMany([symbols[line][1] for line in todo])
+            for line, newaddr in zip(todo, addrs):
+                self.cache[line] = '%s = 0x%x;' %(symbols[line][0], newaddr)
+            self.changed = True
+
+        self.file.writelines(self.cache.get(line, line) + '\n' for line in lines)
+
+    def finish(self):
+        self.file.close()
+        self.converter.saveTableCache(self.cachefile, self.cache, self.changed or bool(self.old))
+
+        # Only replaced when it changes
+        if os.path.isfile(self.newfile) and filecmp.cmp(self.temp, self.newfile, shallow=False):
+            os.remove(self.temp)
+        else:
+            os.replace(self.temp, self.newfile)
+
+    def abort(self):
+        self.file.close()
+        removeTemp(self.temp)
+
+def convertTables(table, targets):
+    # Converts a symbol map for several regions at once
+    # targets: [(converter, converted map filename)]
+    # The map is read once, and every chunk of it is converted for each region in turn
+    if isinstance(table, str):
+        table = iterLines(table)
+
+    targets = list({os.path.abspath(newfile): (converter, newfile) for converter, newfile in targets}.items())
+    targets.sort(key=operator.itemgetter(0))
+
+    # Projects built at the same time share the converted maps,
+    # so each one is only written by one of them
+    with contextlib.ExitStack() as stack:
+        for path, target in targets:
+            stack.enter_context(_lockFor(path))
+
+        writers = []
+        try:
+            for path, (converter, newfile) in targets:
+                writers.append(TableWriter(converter, newfile))
+
             while True:
-                res += c.encode()
-                if c == '\\':
-                    pos += 1
-                    res += file_str[pos].encode()
-                pos += 1
-                c = file_str[pos]
-                if c == q:
+                chunk = list(itertools.islice(table, 0x1000))
+                if not chunk:
                     break
-            res += c.encode()
-        elif c == '/':
-            pos += 1
-            c = file_str[pos]
-            if c != '*':
-                res += b'/'
-                pos -= 1
-            else:
-                res += b' '
-                while True:
-                    p = c
-                    pos += 1
-                    c = file_str[pos]
-                    if c == '/' and p == '*':
-                        break
-        else:
-            res += c.encode()
-        pos += 1
 
-    return res.decode()
+                symbols = {}
+                for writer in writers:
+                    writer.write(chunk, symbols)
 
-def convertTable(oldfile, newfile):
-    with open(oldfile) as f:
-        lines = f.readlines()
+            for writer in writers:
+                writer.finish()
+
+        except BaseException:
+            for writer in writers:
+                writer.abort()
+            raise
+
+_locks = {}
+_locksLock = threading.Lock()
+
+def _lockFor(filename):
+    with _locksLock:
+        return _locks.setdefault(os.path.abspath(filename), threading.Lock())
 
-    lines = removeCComments(''.join(lines)).split('\n')
+def loadAddrFile(name, path='.'):
+    filename = os.path.abspath(os.path.join(path, 'addr_%s.txt' %name))
+    with open(filename, 'rb') as f:
+        source = f.read()
+
+    # The text file is only parsed again once it changes
+    key = hashlib.sha256(source).digest()
+    cachefile = os.path.join(path, 'addr_%s.cache' %name)
+
+    addressMap = AddressMap.load(cachefile, key)
+    if addressMap is None:
+        addressMap = AddressMap.parse(source.decode().splitlines())
+        try:
+            addressMap.save(cachefile, key)
+        except OSError:
+            pass
+
+    return AddrConverter(name, filename, addressMap, key.hex())
+
+def findRegions(path='.'):
+    regions = []
+    for fn in sorted(os.listdir(path)):
+        if fn.startswith('addr_') and fn.endswith('.txt'):
+            regions.append(fn[5:-4])
+
+    return regions
+
+_tokenPattern = re.compile(r'/\*|//|"(?:[^"\\\n]|\\.)*"?|\'(?:[^\'\\\n]|\\.)*\'?')
+
+def removeCComments(lines):
+    # Yields the lines of a C-style file with comments removed, in a single pass
+    # A block comment becomes a space, and joins the lines it spans into one (string literals are kept as is)
+    parts = []
+    inComment = False
 
-    newlines = []
     for line in lines:
-        if '//' in line:
-            eol_comment_pos = line.find('//')
-            line = line[:eol_comment_pos]
-
-        line = line.strip()
-        
-        if line[-1:] == ';':
-            name, addr = line[:-1].split('=')
-            name = name.strip()
-            addr = addr.strip()
-
-            if name == '__deleted_virtual_called':
-                __deleted_virtual_called = eval(addr)
-            
-            newaddr = convert(eval(addr))
-            newlines.append('%s = 0x%x;\n' %(name, newaddr))
-        else:
-            newlines.append(line+'\n')
+        text = line.rstrip('\n')
+
+        # Most lines only have line comments, if any
+        if not inComment and '/*' not in text and '"' not in text and '\'' not in text:
+            comment = text.find('//')
+            if comment != -1:
+                text = text[:comment]
+
+            if parts:
+                parts.append(text)
+                text = ''.join(parts)
+                parts = []
+
+            if line[-1:] == '\n':
+                yield text
+            else:
+                parts.append(text)
+            continue
+
+        pos = 0
+        while True:
+            if inComment:
+                end = text.find('*/', pos)
+                if end == -1:
+                    break
+
+                pos = end + 2
+                inComment = False
+                continue
+
+            match = _tokenPattern.search(text, pos)
+            if match is None:
+                parts.append(text[pos:])
+                break
+
+            token = match.group()
+            parts.append(text[pos:match.start()])
+            if token == '//':
+                break
+
+            elif token == '/*':
+                parts.append(' ')
+                inComment = True
+                pos = match.end()
+
+            else:
+                parts.append(token)
+                pos = match.end()
+
+        if not inComment and line.endswith('\n'):
+            yield ''.join(parts)
+            parts = []
+
+    yield ''.join(parts)
+
+def iterLines(oldfile):
+    # Yields the stripped lines of a symbol map, without comments
+    with open(oldfile) as f:
+        for line in removeCComments(f):
+            yield line.strip()
 
-    with open(newfile, 'w') as f:
-        f.writelines(newlines)
+def parseSymbol(line):
+    # (name, address) of a "name = address;" line
+    name, addr = line[:-1].split('=')
+    return name.strip(), parseNumber(addr)
@@ -1,20 +1,28 @@
 # CafeLoader Project Compiler
 # By Kinnay
 
-import sys, os, shutil, yaml, subprocess, struct
-import elftools.elf.elffile
+import sys, os, yaml, struct, hashlib, argparse, asyncio, time, functools, threading
 import addrconv
-from elf import ELF
+from delta import updateFiles
+from deps import DependencyGraph, parseDepFile, scanIncludes
+from elf import ELF, extractSections
+from manifest import Manifest
+from patches import Patch, PatchIndex, coalescePatches, packPatches
+from objcache import ObjectCache, includedFiles, writeDepFile
+from scheduler import BuildError, BuildGraph, runGraphs
+from symindex import SECTIONS as SYMBOL_SECTIONS, SymbolIndex, writeIndex
 
 
 # Change the following (use / instead of \)
 GHS_PATH = 'D:/Greenhills/ghs/multi5327/'
 
+ASM_INCLUDES = ['../files/include']
+
 
 TEMPLATE = """#!gbuild
 primaryTarget=ppc_cos_ndebug.tgt
 [Project]
-\t-object_dir=objs
+\t-object_dir=%s
 \t--no_commons
 \t-c99
 \t-only_explicit_reg_use
@@ -62,38 +70,95 @@ SECTIONS
 }"""
 
 
-def printUsage():
-    print('Usage:')
-    print('python compiler.py <project> <version>')
+def objPath(fn, ext='.o', objdir='objs'):
+    return '%s/%s' %(objdir, os.path.basename(os.path.splitext(fn)[0] + ext))
 
-class Linker:
-    def loadFile(self, filename):
-        f = open(filename, 'rb')
-        self.elf = elftools.elf.elffile.ELFFile(f)
-        self.loadSymbols()
-        f.close()
+def templateFlags(template):
+    flags = []
+    for line in template.split('\n'):
+        flag = line.strip()
+        if not line.startswith('\t') or flag.startswith('-object_dir=') or flag == '-MD':
+            continue
 
-    def loadSymbols(self):
-        self.symbols = {}
-        sections = list(self.elf.iter_sections())
-        symtable = self.elf.get_section_by_name('.symtab')
-        
-        for symbol in symtable.iter_symbols():
-            if not symbol.name: continue
-            
-            entry = symbol.entry
-            value = entry['st_value']
-            shndx = entry['st_shndx']
+        flags.append(flag)
+
+    return flags
+
+def toolId(name):
+    tool = os.path.join(GHS_PATH, name)
+    try:
+        stat = os.stat(tool)
+    except OSError:
+        return tool
 
-            if shndx in ['SHN_ABS', 'SHN_UNDEF']: continue
-            
-            section = sections[shndx]
-            if section.name != '.text': continue
+    return '%s %d %d' %(tool, stat.st_size, stat.st_mtime)
 
-            self.symbols[symbol.name] = value
+def compilerId():
+    return toolId('cxppc.exe')
 
-    def getSymbol(self, name):
-        return self.symbols[name]
+def fileStamp(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+
+    return stat.st_mtime_ns, stat.st_size
+
+class Linker:
+    def __init__(self):
+        self.filename = None
+        self.stamp = None
+        self.symbols = {}  # name -> (value, size, section), or the SymbolIndex of the file
+
+    def isLoaded(self, filename):
+        return self.filename == filename and self.stamp == fileStamp(filename)
+
+    def close(self):
+        # The index must be unmapped before it can be replaced
+        if isinstance(self.symbols, SymbolIndex):
+            self.symbols.close()
+        self.symbols = {}
+
+    def loadFile(self, filename):
+        self.close()
+        self.filename = filename
+        self.stamp = fileStamp(filename)
+
+        with ELF(filename, lazy=True) as elf:
+            for symbol in elf.getSymbols():
+                if symbol.name and symbol.section is not None and symbol.section.name in SYMBOL_SECTIONS:
+                    self.symbols[symbol.name] = (symbol.value, symbol.size, symbol.section.name)
+
+    def loadIndex(self, indexfile, filename, key):
+        # Symbol index saved by the last link, valid as long as the linked file did not change
+        try:
+            index = SymbolIndex(indexfile)
+        except (OSError, ValueError):
+            return False
+
+        if index.key != key:
+            index.close()
+            return False
+
+        self.close()
+        self.filename = filename
+        self.stamp = fileStamp(filename)
+        self.symbols = index
+        return True
+
+    def saveIndex(self, indexfile, key):
+        writeIndex(indexfile, key, self.symbols)
+
+    def getSymbol(self, name, sections=('.text',)):
+        symbol = self.symbols.get(name)
+        if symbol is None:
+            raise BuildError("Undefined symbol '%s'" %name)
+
+        value, size, section = symbol
+        if section not in sections:
+            raise BuildError("Symbol '%s' is in %s, not in %s" %(name, section, ' or '.join(sections)))
+
+        return value
 
     def doB(self, symbol, src):
         symaddr = self.getSymbol(symbol)
@@ -107,235 +172,502 @@ class Linker:
         instr |= 0x48000001
         return "%x" %instr
 
+class BuildContext:
+    def __init__(self, root, converter, perRegion=False, label=None, cache=None):
+        self.root = root
+        self.converter = converter
+        self.linker = Linker()
+        self.label = label  # Prefixes the tool output when several builds run at once
+        self.cache = cache  # ObjectCache, or None when disabled
+
+        # Every region gets its own output tree when several are built together
+        self.perRegion = perRegion
+        if perRegion:
+            self.outdir = 'Out/%s' %converter.region
+            self.objdir = 'objs/%s' %converter.region
+        else:
+            self.outdir = 'Out'
+            self.objdir = 'objs'
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
 class Module:
-    def __init__(self, fn):
+    def __init__(self, fn, root='.'):
         self.name = os.path.splitext(fn)[0]
-        with open(fn) as f:
+        with open(os.path.join(root, fn)) as f:
             module = yaml.safe_load(f)
 
         self.codefiles = module.get('Files', [])
         self.hooks = module.get('Hooks', [])
 
-    def build(self):
-        self.objfiles = []
+    def build(self, ctx):
+        # Modules are shared between regions, so the results are returned instead of stored
+        objfiles = []
+        asmjobs = []
         for codefile in self.codefiles:
             if codefile.endswith('.cpp'):
-                self.objfiles.append('objs/%s' %os.path.basename(os.path.splitext(codefile)[0]+'.o'))
+                objfiles.append(objPath(codefile, objdir=ctx.objdir))
             if codefile.endswith('.S'):
-                self.buildAsm(codefile)
-        return self.objfiles
-
-    def buildAsm(self, fn):
-        print("Assembling '%s'" %fn)
-        obj = os.path.basename(fn+'.o')
-        cmd = '"%s" -I ../files/include %s -o objs/%s' %(os.path.join(GHS_PATH, 'asppc.exe'), fn, obj)
-        error = subprocess.call(cmd)
-        if error:
-            print('Build failed!!')
-            print('Error code: %i' %error)
-            sys.exit(error)
-        self.objfiles.append('objs/%s' %obj)
+                obj, cmd = self.buildAsm(codefile, ctx.objdir)
+                objfiles.append(obj)
+                asmjobs.append((codefile, obj, cmd))
+        return objfiles, asmjobs
+
+    def buildAsm(self, fn, objdir):
+        # Only queued here, the jobs of every module are run by the build graph
+        obj = '%s/%s' %(objdir, os.path.basename(fn+'.o'))
+        includes = ''.join('-I %s ' %folder for folder in ASM_INCLUDES)
+        cmd = '"%s" %s%s -o %s' %(os.path.join(GHS_PATH, 'asppc.exe'), includes, fn, obj)
+        return obj, cmd
+
+    def getPatches(self, ctx):
+        linker = ctx.linker
+
+        def hookError(hook, e):
+            return BuildError("Module '%s', %s hook at %s: %s" %(self.name, hook['type'], hook['addr'], e))
 
-    def getPatches(self):
-        patchList = {}
+        addresses = []
         for hook in self.hooks:
-            hooktype = hook['type']
-            addr = int(hook['addr'], 16)
-            
-            if hooktype == 'patch':
-                addr = addrconv.convert(addr, True)
-                patchList['%08x' %addr] = hook['data']
+            try:
+                addresses.append(int(hook['addr'], 16))
+            except ValueError as e:
+                raise hookError(hook, e)
 
-            elif hooktype == 'nop':
-                addr = addrconv.convert(addr, True)
-                patchList['%08x' %addr] = '60000000'
+        # The addresses of every hook are converted at once
+        addresses = ctx.converter.convertMany(addresses, strict=False)
 
-            elif hooktype == 'branch':
-                addr = addrconv.convert(addr)
-                if hook['instr'] == 'b':
-                    data = linker.doB(hook['func'], addr)
-                elif hook['instr'] == 'bl':
-                    data = linker.doBL(hook['func'], addr)
+        patches = []
+        for hook, addr in zip(self.hooks, addresses):
+            try:
+                if addr is None:
+                    raise ValueError("Invalid or unimplemented address: 0x%s" %hook['addr'])
 
-                patchList['%08x' %addr] = data
+                patches.append(Patch(addr, self.getPatch(hook, addr, linker), self.name, hook))
+            except (BuildError, ValueError) as e:
+                raise hookError(hook, e)
 
-            elif hooktype == 'funcptr':
-                addr = addrconv.convert(addr)
-                patchList['%08x' %addr] = '%08x' %linker.getSymbol(hook['func'])
+        return patches
 
-        return patchList
+    def getPatch(self, hook, addr, linker):
+        # addr is the converted address of the hook, returns the bytes written there
+        hooktype = hook['type']
+
+        if hooktype == 'patch':
+            return bytes.fromhex(hook['data'])
+
+        elif hooktype == 'nop':
+            return bytes.fromhex('60000000')
+
+        elif hooktype == 'branch':
+            if hook['instr'] == 'b':
+                data = linker.doB(hook['func'], addr)
+            elif hook['instr'] == 'bl':
+                data = linker.doBL(hook['func'], addr)
+
+            return bytes.fromhex(data)
+
+        elif hooktype == 'funcptr':
+            return struct.pack('>I', linker.getSymbol(hook['func'], SYMBOL_SECTIONS))
+
+        return b''
 
 class Project:
-    def __init__(self, proj):
+    def __init__(self, proj, ctx, modules=None):
         self.splitSections = proj.get('SplitSections', True)
         self.genHeader = proj.get('BuildHeader', False)
         self.include = proj.get('Include', None)
         self.name = proj['Name']
-        self.outdir = 'Out'
+        self.ctx = ctx
+        self.converter = ctx.converter
+        self.linker = ctx.linker
+        self.outdir = ctx.outdir
+        self.objdir = ctx.objdir
+        self.manifest = None
+        self.depgraph = DependencyGraph()
+
+        # Paths are relative to the project folder
+        region = self.converter.region
+        if ctx.perRegion:
+            self.gpjfile = 'project_%s.gpj' %region
+            self.ldfile = 'project_%s.ld' %region
+            self.outfile = '%s_%s.o' %(self.name, region)
+        else:
+            self.gpjfile = 'project.gpj'
+            self.ldfile = 'project.ld'
+            self.outfile = self.name + '.o'
+
+        self.symtable = '../files/game_%s.x' %region
+        self.patchIndex = None  # Every hook's patch, by address, once the patches were built
+        self.tables = None  # TableJob shared with the other projects converting the same game.x
         
-        files = proj.get('Modules', [])
-        self.modules = []
-        for fn in files:
-            self.modules.append(Module(fn))
+        self.modulefiles = proj.get('Modules', [])
+        if modules is None:
+            modules = [Module(fn, ctx.root) for fn in self.modulefiles]
+        self.modules = modules
+
+    def path(self, *parts):
+        return self.ctx.path(*parts)
 
     def build(self):
-        if not os.path.isdir(self.outdir):
-            os.mkdir(self.outdir)
+        self.tables = TableJob([self])
+        runGraphs([self.createGraph()])
+        print('\n' + '=' * 50 + '\n')
+
+    def createGraph(self):
+        os.makedirs(self.path(self.outdir), exist_ok=True)
+        os.makedirs(self.path(self.objdir), exist_ok=True)
 
-        if not os.path.isdir('objs'):
-            os.mkdir('objs')
+        # Kept between builds in watch mode, so unchanged files are not hashed again
+        if self.manifest is None:
+            self.manifest = Manifest(self.path(self.outdir, 'manifest.json'), self.ctx.root)
+
+        print("*** Building '%s' (%s) ***\n" %(self.name, self.converter.region))
 
         self.buildGPJ()
-        self.buildGHS()
+        self.writeLinkerScript()
+
+        self.objfiles = []
+        self.asmjobs = {}
+        for module in self.modules:
+            objfiles, jobs = module.build(self.ctx)
+            self.objfiles += objfiles
+            for fn, obj, cmd in jobs:
+                self.asmjobs[obj] = (fn, cmd)
+
+        graph = BuildGraph(name=self.ctx.label, cwd=self.ctx.root)
+        if self.isToolchainUpToDate():
+            print('Objects and linked output are up to date, only regenerating the patches')
+            self.addSteps(graph, False)
+        else:
+            self.addSteps(graph)
+        return graph
+
+    def isToolchainUpToDate(self):
+        # True when nothing but the hooks (or nothing at all) changed since the last link
+        if self.stalefiles or not self.objfiles:
+            return False
+
+        for obj, (fn, cmd) in self.asmjobs.items():
+            if not self.manifest.isUpToDate('asm:' + fn, self.asmInputs(fn), [obj], self.asmKey(cmd)):
+                return False
+
+        if not self.manifest.isUpToDate('addrtable', self.tableInputs(), [self.symtable]):
+            return False
+
+        # The link phase records the stripped objects, so they are only compared once stripped
+        for obj in self.objfiles:
+            if not self.manifest.isUpToDate('strip:' + obj, [obj], [obj]):
+                return False
+
+        inputs, key = self.linkInputs()
+        return self.manifest.isUpToDate('link', inputs, [self.outfile], key)
+
+    def addSteps(self, graph, toolchain=True):
+        out = self.outfile
+
+        if toolchain:
+            graph.add('addrtable', self.convertTable, ['../files/game.x'], [self.symtable])
+
+            if self.stalefiles:
+                graph.add('gbuild', self.buildGHS, [self.gpjfile], [objPath(fn, objdir=self.objdir) for fn in self.stalefiles])
+
+            for obj, (fn, cmd) in self.asmjobs.items():
+                graph.add('asm:' + fn, functools.partial(self.buildAsm, fn=fn, obj=obj, cmd=cmd), [fn], [obj])
+
+        if self.objfiles and toolchain:
+            stripped = []
+            for obj in self.objfiles:
+                if 'stripped:' + obj not in stripped:
+                    graph.add('strip:' + obj, functools.partial(self.stripRelocations, fname=obj), [obj], ['stripped:' + obj])
+                    stripped.append('stripped:' + obj)
+
+            graph.add('link', self.link, stripped + [self.symtable, self.ldfile], [out])
 
         if self.objfiles:
-            self.link()
-            self.copyout()
+            binfiles = [self.outPath('Code.bin'), self.outPath('Data.bin')]
+            graph.add('copyout', lambda: self.runPhase('copyout', [out], binfiles, self.copyout), [out], binfiles)
+
             if self.genHeader:
-                self.buildHeader('Code')
+                header = [self.outPath('Code.h')]
+                graph.add('header', lambda: self.runPhase('header', binfiles[:1], header, lambda: self.buildHeader('Code')), binfiles[:1], header)
 
-        self.buildPatches()
-        self.setAddressBin()
+        patches = [self.outPath('Patches.hax')]
+        graph.add('patches', lambda: self.runPhase('patches', self.patchInputs(), patches, self.buildPatches), [out], patches)
 
-        print('\n' + '=' * 50 + '\n')
+        addrbin = [self.outPath('Addr.bin')]
+        graph.add('addr', lambda: self.runPhase('addr', [self.converter.filename], addrbin, self.setAddressBin), [], addrbin)
 
-    def buildPatches(self):
-        patches = {}
-        for module in self.modules:
-            patches.update(module.getPatches())
-
-        patchdata = struct.pack('>H', len(patches))
-        if patches:
-            for address, data in patches.items():
-                rawaddress = bytes.fromhex(address)
-                rawdata = bytes.fromhex(data)
-                patchdata += struct.pack('>H', len(rawdata))
-                patchdata += rawaddress
-                patchdata += rawdata
-
-        with open('Out/Patches.hax', 'wb') as f:
-            f.write(patchdata)
+    def outPath(self, fn):
+        return '%s/%s' %(self.outdir, fn)
 
-    def setAddressBin(self):
-        addrdata = struct.pack('>2I', addrconv.symbols['textAddr'], addrconv.symbols['dataAddr'])
-        with open('Out/Addr.bin', 'wb') as f:
-            f.write(addrdata)
+    def runPhase(self, phase, inputs, outputs, func, key=None):
+        if self.manifest.isUpToDate(phase, inputs, outputs, key):
+            print('%s: up to date' %', '.join(outputs))
+            return
 
-    def buildGPJ(self):
-        fileList = ''
-        for module in self.modules:
-            for fn in module.codefiles:
-                fileList += fn + '\n'
+        self.manifest.forget(phase)
+        func()
+        self.manifest.record(phase, inputs, key)
 
-        include = '../files/include'
-        if self.include:
-            include += '\n\t-I%s' %self.include
+    def patchInputs(self):
+        inputs = self.modulefiles + [self.converter.filename]
+        if os.path.isfile(self.path(self.outfile)):
+            inputs.append(self.outfile)
 
-        template = TEMPLATE %(
-            addrconv.region,
-            addrconv.symbols['textAddr'],
-            addrconv.symbols['dataAddr'],
-            include,
-            fileList.strip()
-            )
+        return inputs
 
-        with open('project.gpj', 'w') as f:
-            f.write(template)
+    def loadSymbols(self):
+        out = self.path(self.outfile)
+        if self.linker.isLoaded(out):
+            return
 
-    def buildGHS(self):
-        print("*** Building '%s' ***\n" %self.name)
+        key = self.manifest.hash(self.outfile)
+        indexfile = os.path.splitext(out)[0] + '.sym'
+        if not self.linker.loadIndex(indexfile, out, key):
+            self.linker.loadFile(out)
+            self.linker.saveIndex(indexfile, key)
 
-        cmd = '"%s" -top project.gpj' %(os.path.join(GHS_PATH, 'gbuild.exe'))
-        error = subprocess.call(cmd)
-        if error:
-            print('Build failed!!')
-            print('Error code: %i' %error)
-            sys.exit(error)
+    def buildPatches(self):
+        if os.path.isfile(self.path(self.outfile)):
+            self.loadSymbols()
 
-        self.objfiles = []
+        patches = []
         for module in self.modules:
-            self.objfiles += module.build()
+            patches += module.getPatches(self.ctx)
+
+        # Hooks writing different values to the same bytes would silently depend on the module order
+        self.patchIndex = PatchIndex(patches)
+        conflicts = self.patchIndex.check()
+        if conflicts:
+            raise BuildError('\n'.join('%s conflicts with %s' %(second, first) for first, second in conflicts))
+
+        patches = [(patch.address, patch.data) for patch in patches]
+        records = coalescePatches(patches)
+        try:
+            patchdata = packPatches(records)
+        except ValueError as e:
+            raise BuildError(str(e))
+
+        if len(records) < len(patches):
+            saved = sum(6 + len(data) for address, data in patches) + 2 - len(patchdata)
+            print('%d patches merged into %d records, %d bytes saved' %(len(patches), len(records), saved))
+
+        with open(self.path(self.outPath('Patches.hax')), 'wb') as f:
+            f.write(patchdata)
 
-    def link(self):
-        print("Linking '%s'" %self.name)
+    def setAddressBin(self):
+        addrdata = struct.pack('>2I', self.converter.symbols['textAddr'], self.converter.symbols['dataAddr'])
+        with open(self.path(self.outPath('Addr.bin')), 'wb') as f:
+            f.write(addrdata)
 
-        ### Remove type 11 relations ###
+    def findStaleSources(self, flagsKey):
+        sources = []
+        stale = []
+        for module in self.modules:
+            for fn in module.codefiles:
+                if fn.endswith('.cpp') and fn not in sources:
+                    sources.append(fn)
 
-        for fname in self.objfiles:
-            obj = ELF(fname)
+        for fn in sources:
+            depfile = objPath(fn, '.d', self.objdir)
+            if not os.path.isfile(self.path(depfile)):
+                stale.append(fn)
+                continue
 
-            for section in obj.secHeadEnts:
-                if section.type != 4:
-                    continue
+            self.depgraph.add(fn, parseDepFile(self.path(depfile)))
+            if not self.manifest.isUpToDate('compile:' + fn, self.depgraph.deps[fn], [objPath(fn, objdir=self.objdir), depfile], flagsKey):
+                stale.append(fn)
 
-                toRemove = []
-                for i, rel in enumerate(section.relocations):
-                    if (rel.info & 0xFF) == 0x0B:
-                        toRemove.append(i)
+        print('%d of %d source files need to be compiled' %(len(stale), len(sources)))
+        return stale
 
-                toRemove.sort(reverse=True)
-                for i in toRemove:
-                    del section.relocations[i]
+    def buildGPJ(self):
+        include = '../files/include'
+        if self.include:
+            include += '\n\t-I%s' %self.include
+
+        def render(fileList):
+            return TEMPLATE %(
+                self.objdir,
+                self.converter.region,
+                self.converter.symbols['textAddr'],
+                self.converter.symbols['dataAddr'],
+                include,
+                fileList
+                )
+
+        # Sources only need to be rebuilt when they, a header they include or the flags change
+        self.render = render
+        self.flagsKey = hashlib.sha256(render('').encode()).hexdigest()
+        self.stalefiles = self.findStaleSources(self.flagsKey)
+
+        with open(self.path(self.gpjfile), 'w') as f:
+            f.write(render('\n'.join(self.stalefiles)))
+
+    async def restoreCached(self, graph):
+        cache = self.ctx.cache
+
+        # The object folder is the only flag that does not affect the object
+        template = self.render('')
+        flags = templateFlags(template)
+        cacheFlags = '\n'.join([compilerId()] + [line for line in template.split('\n') if '-object_dir=' not in line])
+
+        cmd = '"%s" -E %s' %(os.path.join(GHS_PATH, 'cxppc.exe'), ' '.join(flags))
+
+        async def lookup(fn):
+            error, output = await graph.captureCommand('%s %s' %(cmd, fn))
+            if error:
+                return None  # Let gbuild report the error
+
+            key = cache.key(output, cacheFlags)
+            obj = objPath(fn, objdir=self.objdir)
+            if not await graph.runFunction(cache.lookup, key, self.path(obj)):
+                return key
+
+            writeDepFile(self.path(objPath(fn, '.d', self.objdir)), obj, includedFiles(output) or [fn])
+            return ''
+
+        keys = await asyncio.gather(*[lookup(fn) for fn in self.stalefiles])
+        return {fn: key for fn, key in zip(self.stalefiles, keys) if key != ''}
+
+    async def buildGHS(self, graph):
+        tocompile = dict.fromkeys(self.stalefiles)
+        if self.ctx.cache is not None:
+            tocompile = await self.restoreCached(graph)
+            print('%d of %d source files restored from the object cache' %(len(self.stalefiles) - len(tocompile), len(self.stalefiles)))
+
+            if len(tocompile) != len(self.stalefiles):
+                with open(self.path(self.gpjfile), 'w') as f:
+                    f.write(self.render('\n'.join(tocompile)))
+
+        if tocompile:
+            cmd = '"%s" -top %s' %(os.path.join(GHS_PATH, 'gbuild.exe'), self.gpjfile)
+            error = await graph.runCommand(cmd, graph.prefix('gbuild'))
+            if error:
+                raise BuildError("'gbuild' failed with error code %i" %error, error)
+
+        for fn, key in tocompile.items():
+            if key is not None:
+                await graph.runFunction(self.ctx.cache.store, key, self.path(objPath(fn, objdir=self.objdir)))
+
+        compiled = []
+        for fn in self.stalefiles:
+            depfile = objPath(fn, '.d', self.objdir)
+            if os.path.isfile(self.path(depfile)):
+                self.depgraph.add(fn, parseDepFile(self.path(depfile)))
+                compiled.append(fn)
+
+        # Headers shared by the sources are only hashed again once per gbuild run
+        self.manifest.invalidate({dep for fn in compiled for dep in self.depgraph.deps[fn]})
+        for fn in compiled:
+            self.manifest.record('compile:' + fn, self.depgraph.deps[fn], self.flagsKey, save=False, rehash=False)
+
+        self.manifest.save()
+
+    def tableInputs(self):
+        return ['../files/game.x', self.converter.filename]
+
+    def convertTable(self):
+        # The tables of the other regions are converted along with this one
+        self.runPhase('addrtable', self.tableInputs(), [self.symtable], self.tables.run)
+
+    def writeLinkerScript(self):
+        textAddr = self.converter.symbols['textAddr']
+        dataAddr = self.converter.symbols['dataAddr']
+
+        script = SymTableTemplate % (
+            hex(textAddr),
+            hex(0x10000000 - textAddr),
+            hex(dataAddr),
+            hex(0xC0000000 - dataAddr),
+        )
+
+        # Only touch the file when the addresses change, so its hash stays stable
+        ldfile = self.path(self.ldfile)
+        if os.path.isfile(ldfile):
+            with open(ldfile) as symfile:
+                if symfile.read() == script:
+                    return
+
+        with open(ldfile, 'w') as symfile:
+            symfile.write(script)
+
+    async def stripRelocations(self, graph, fname):
+        # The phase records the stripped object, so it is only stripped again once rebuilt
+        phase = 'strip:' + fname
+        if self.manifest.isUpToDate(phase, [fname], [fname]):
+            return
+
+        await graph.runProcess(stripRelocations, self.path(fname))
+        self.manifest.record(phase, [fname], save=False)
+
+    def asmInputs(self, fn):
+        # Sources are assembled again when they, or a file they include, change
+        self.depgraph.add(fn, scanIncludes(fn, ASM_INCLUDES, self.ctx.root))
+        return self.depgraph.deps[fn]
+
+    def asmKey(self, cmd):
+        return '%s\n%s' %(cmd, toolId('asppc.exe'))
+
+    async def buildAsm(self, graph, fn, obj, cmd):
+        inputs = self.asmInputs(fn)
+        key = self.asmKey(cmd)
+        if self.manifest.isUpToDate('asm:' + fn, inputs, [obj], key):
+            return
+
+        self.manifest.forget('asm:' + fn)
+        error = await graph.runCommand(cmd, graph.prefix('asm:' + fn))
+        if error:
+            raise BuildError("'%s' failed with error code %i" %(fn, error), error)
 
-            with open(fname, 'wb') as outf:
-                outf.write(obj.saveRel())
+        self.manifest.record('asm:' + fn, inputs, key)
 
-        ################################
+    def linkInputs(self):
+        inputs = self.objfiles + [self.symtable, self.converter.filename, self.ldfile]
+        return inputs, ' '.join(self.objfiles)
 
-        symtable = '../files/game_%s.x' %addrconv.region
-        addrconv.convertTable('../files/game.x', symtable)
-        
-        out = self.name + '.o'
-        symfiles = '-T %s' %symtable
+    async def link(self, graph):
+        # Runs after the strip steps, so the objects are checked and recorded as stripped
+        out = self.outfile
+        inputs, key = self.linkInputs()
+        if self.manifest.isUpToDate('link', inputs, [out], key):
+            self.manifest.save()  # Keeps the strip phases
+            print('%s: up to date' %out)
+            return
 
-        textAddr = addrconv.symbols['textAddr']
-        dataAddr = addrconv.symbols['dataAddr']
+        self.manifest.forget('link')
 
-        with open("project.ld", "w+") as symfile:
-            symfile.write(SymTableTemplate % (
-                hex(textAddr),
-                hex(0x10000000 - textAddr),
-                hex(dataAddr),
-                hex(0xC0000000 - dataAddr),
-            ))
+        print("Linking '%s'" %self.outfile)
 
-        symfiles += ' -T project.ld'
+        symfiles = '-T %s' %self.symtable
+        symfiles += ' -T %s' %self.ldfile
 
         syms = ''
-        for sym, addr in addrconv.symbols.items():
+        for sym, addr in self.converter.symbols.items():
             syms += ' -D%s=0x%x' %(sym, addr)
 
         cmd = '"%s" %s%s -o "%s" ' %(os.path.join(GHS_PATH, 'elxr.exe'), symfiles, syms, out)
         cmd += ' '.join(self.objfiles)
-        error = subprocess.call(cmd)
+        error = await graph.runCommand(cmd, graph.prefix('link'))
         if error:
-            print('Link Failed!!')
-            print('Error code: %i' %error)
-            sys.exit(error)
+            raise BuildError("'elxr' failed with error code %i" %error, error)
 
-        linker.loadFile(out)
+        self.manifest.record('link', inputs, key)
+        await graph.runFunction(self.loadSymbols)
 
     def copyout(self):
         if self.splitSections:
-            self.objcopy(('.text',), 'Code')
-            self.objcopy(('.rodata', '.data'), 'Data')
+            # Both files are written in a single pass over the linked output
+            extractSections(self.path(self.outfile), [
+                (self.path(self.outPath('Code.bin')), ('.text',)),
+                (self.path(self.outPath('Data.bin')), ('.rodata', '.data')),
+            ])
         else:
             raise NotImplementedError
 
-    def objcopy(self, sections, out):
-        obj = ELF("%s.o" %self.name)
-
-        outBuffer = bytearray()
-        for section in sections:
-            sectionObj = obj.getSectionByName(section)
-            if sectionObj:
-                outBuffer += sectionObj.data
-
-        with open('Out/%s.bin' %out, 'wb') as f:
-            f.write(outBuffer)
-
     def buildHeader(self, binfile):
-        with open('Out/%s.bin' %binfile, 'rb') as f:
+        with open(self.path(self.outPath('%s.bin' %binfile)), 'rb') as f:
             data = f.read()
 
         header = '\nstatic const unsigned char %s_bin[] = {\n ' %binfile
@@ -350,42 +682,346 @@ class Project:
         header += '\n};\nstatic const unsigned int %s_bin_len = ' %binfile
         header += str(len(data)) + ';\n'
         
-        with open('Out/%s.h' %binfile, 'w') as f:
+        with open(self.path(self.outPath('%s.h' %binfile)), 'w') as f:
             f.write(header)
 
-def buildProject(proj):
-    os.chdir(proj)
-    with open('project.yaml') as f:
-        project = Project(yaml.safe_load(f))
+class TableJob:
+    # Converts game.x for every project using it, so it is only read once for all of their regions
+    def __init__(self, projects):
+        self.projects = projects
+        self.lock = threading.Lock()
+        self.done = False
+
+    def run(self):
+        with self.lock:
+            if self.done:
+                return
+
+            stale = [project for project in self.projects if not project.manifest.isUpToDate('addrtable', project.tableInputs(), [project.symtable])]
+            for project in stale:
+                project.manifest.forget('addrtable')
+
+            if stale:
+                addrconv.convertTables(stale[0].path('../files/game.x'), [(project.converter, project.path(project.symtable)) for project in stale])
+
+            for project in stale:
+                project.manifest.record('addrtable', project.tableInputs())
+
+            self.done = True
+
+def stripRelocations(filename):
+    ### Remove type 11 relations ###
+    # Runs in a worker process, and leaves objects with nothing to remove untouched
+    # The remaining relocations are compacted in place, without rewriting the rest of the object
+
+    with ELF(filename, writable=True) as obj:
+        removed = 0
+        for section in obj.secHeadEnts:
+            if section.type == 4:
+                removed += section.relocations.remove(types=(0x0B,))
+
+        if removed:
+            obj.saveInPlace()
 
-    project.build()
-    os.chdir('..')
+    return removed
 
-def copyOutFiles():
-    if not os.path.isdir('OutProj'):
-        os.mkdir('OutProj')
 
-    shutil.copy(sys.argv[1]+'/Out/Addr.bin', 'OutProj/Addr.bin')
-    shutil.copy(sys.argv[1]+'/Out/Patches.hax', 'OutProj/Patches.hax')
-    shutil.copy(sys.argv[1]+'/Out/Code.bin', 'OutProj/Code.bin')
-    shutil.copy(sys.argv[1]+'/Out/Data.bin', 'OutProj/Data.bin')
+def loadProject(root, converters, label=None, cache=None):
+    with open(os.path.join(root, 'project.yaml')) as f:
+        project = yaml.safe_load(f)
+
+    # The modules do not depend on the region, so every region shares them
+    modules = [Module(fn, root) for fn in project.get('Modules', [])]
+    perRegion = len(converters) > 1
+
+    projects = []
+    for converter in converters:
+        if perRegion:
+            name = converter.region if label is None else '%s/%s' %(label, converter.region)
+        else:
+            name = label
+
+        ctx = BuildContext(root, converter, perRegion, name, cache)
+        projects.append(Project(project, ctx, modules))
+
+    return projects
+
+def buildProjects(roots, converters, jobs=None, cache=None):
+    projects = []
+    for root in roots:
+        projects += loadProject(root, converters, root if len(roots) > 1 else None, cache)
+
+    runProjects(projects, jobs, cache)
+
+def runProjects(projects, jobs=None, cache=None):
+    # Projects sharing a game.x convert it together
+    groups = {}
+    for project in projects:
+        groups.setdefault(os.path.abspath(project.path('../files/game.x')), []).append(project)
+
+    for group in groups.values():
+        tables = TableJob(group)
+        for project in group:
+            project.tables = tables
+
+    try:
+        runGraphs([project.createGraph() for project in projects], jobs)
+
+    finally:
+        if cache is not None:
+            hits, misses = cache.saveStats()
+            if hits or misses:
+                print('Object cache: %d hits, %d misses' %(hits, misses))
+            cache.evict()
+
+    print('\n' + '=' * 50 + '\n')
+
+def buildProject(proj, converters, cache=None):
+    buildProjects([proj], converters, cache=cache)
+
+def findProjects(path='.'):
+    projects = []
+    for fn in sorted(os.listdir(path)):
+        if os.path.isfile(os.path.join(path, fn, 'project.yaml')):
+            projects.append(fn)
+
+    return projects
+
+class Watcher:
+    # Keeps the parsed projects, address files, game.x and symbols in memory
+    # and rebuilds the projects affected by every change
+    def __init__(self, roots, regions, jobs=None, cache=None, interval=0.5):
+        self.roots = roots
+        self.regions = regions
+        self.jobs = jobs
+        self.cache = cache
+        self.interval = interval
+
+        self.converters = {region: addrconv.loadAddrFile(region) for region in regions}
+        self.projects = {root: self.loadProject(root) for root in roots}
+        self.owners = {}  # Watched file -> projects using it
+
+    def loadProject(self, root):
+        label = root if len(self.roots) > 1 else None
+        return loadProject(root, [self.converters[region] for region in self.regions], label, self.cache)
+
+    def projectFiles(self, root):
+        files = {os.path.join(root, 'project.yaml'), os.path.join(root, '..', 'files', 'game.x')}
+        for project in self.projects[root]:
+            for fn in project.modulefiles:
+                files.add(os.path.join(root, fn))
+
+            for module in project.modules:
+                for fn in module.codefiles:
+                    files.add(os.path.join(root, fn))
+
+            for fn in project.depgraph.dependents:
+                files.add(os.path.join(root, fn))
+
+        return files
+
+    def snapshot(self):
+        stamps = {}
+        self.owners = {}
+        for region, converter in self.converters.items():
+            stamps[converter.filename] = fileStamp(converter.filename)
+            self.owners[converter.filename] = set(self.roots)
+
+        for root in self.roots:
+            for fn in self.projectFiles(root):
+                fn = os.path.normpath(fn)
+                stamps[fn] = fileStamp(fn)
+                self.owners.setdefault(fn, set()).add(root)
+
+        return stamps
+
+    def reload(self, changed):
+        # Returns the projects that have to be rebuilt
+        affected = set()
+
+        for region, converter in list(self.converters.items()):
+            if converter.filename in changed:
+                print("Reloading 'addr_%s.txt'" %region)
+                self.converters[region] = addrconv.loadAddrFile(region)
+                for projects in self.projects.values():
+                    for project in projects:
+                        if project.converter.region == region:
+                            project.ctx.converter = project.converter = self.converters[region]
+                affected.update(self.roots)
+
+        for fn in changed:
+            affected |= self.owners.get(fn, set())
+
+        for root in self.roots:
+            if root not in affected:
+                continue
+
+            if os.path.normpath(os.path.join(root, 'project.yaml')) in changed:
+                print("Reloading '%s'" %os.path.join(root, 'project.yaml'))
+                self.projects[root] = self.loadProject(root)
+                continue
+
+            # The region builds of a project share the same list of modules
+            modules = self.projects[root][0].modules
+            for i, fn in enumerate(self.projects[root][0].modulefiles):
+                if os.path.normpath(os.path.join(root, fn)) in changed:
+                    print("Reloading '%s'" %os.path.join(root, fn))
+                    modules[i] = Module(fn, root)
+
+        return [root for root in self.roots if root in affected]
+
+    def build(self, roots):
+        projects = []
+        for root in roots:
+            projects += self.projects[root]
+
+        try:
+            runProjects(projects, self.jobs, self.cache)
+
+        except BuildError as e:
+            print('Build failed!!')
+            print(e)
+            return
+
+        except Exception as e:
+            print('Build failed!!')
+            print('%s: %s' %(type(e).__name__, e))
+            return
+
+        for root in roots:
+            if len(self.roots) > 1:
+                copyOutFiles(root, self.regions, 'OutProj/%s' %root)
+            else:
+                copyOutFiles(root, self.regions)
+
+    def run(self):
+        self.build(self.roots)
+        stamps = self.snapshot()
+
+        print('Watching for changes... (Press Ctrl+C to stop)')
+        try:
+            while True:
+                time.sleep(self.interval)
+
+                newStamps = self.snapshot()
+                changed = {fn for fn in set(stamps) | set(newStamps) if stamps.get(fn) != newStamps.get(fn)}
+                if not changed:
+                    continue
+
+                for fn in sorted(changed):
+                    print("Changed: '%s'" %fn)
+
+                try:
+                    roots = self.reload(changed)
+                except Exception as e:
+                    print('Could not reload the project!!')
+                    print('%s: %s' %(type(e).__name__, e))
+                    stamps = newStamps
+                    continue
+
+                self.build(roots)
+
+                # The build may have discovered new headers to watch
+                stamps = self.snapshot()
+                print('Watching for changes... (Press Ctrl+C to stop)')
+
+        except KeyboardInterrupt:
+            pass
+
+def copyOutFiles(proj, regions, outdir='OutProj'):
+    for region in regions:
+        if len(regions) > 1:
+            src = '%s/Out/%s' %(proj, region)
+            dest = '%s/%s' %(outdir, region)
+        else:
+            src = '%s/Out' %proj
+            dest = outdir
+
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+
+        # Only changed files are copied, along with a delta against what was there
+        entries = updateFiles(src, dest, ('Addr.bin', 'Patches.hax', 'Code.bin', 'Data.bin'))
+        if not entries:
+            print('%s: up to date' %dest)
+
+        for entry in entries:
+            print('%s/%s' %(dest, entry.describe()))
 
 def main():
-    if len(sys.argv) < 3:
-        printUsage()
+    parser = argparse.ArgumentParser(usage='python compiler.py (<project> | --projects <projects>) (<version> | --regions <regions>)')
+    parser.add_argument('project', nargs='?')
+    parser.add_argument('version', nargs='?')
+    parser.add_argument('--regions', help="comma separated list of regions to build, or 'all' for every addr_<region>.txt")
+    parser.add_argument('--projects', help="comma separated list of projects to build, or 'all' for every folder with a project.yaml")
+    parser.add_argument('-j', '--jobs', type=int, help='maximum number of jobs to run at once')
+    parser.add_argument('--no-cache', action='store_true', help='do not use the object cache')
+    parser.add_argument('--cache-dir', help='object cache folder (default: $CLPC_CACHE_DIR or ~/.clpc_cache)')
+    parser.add_argument('--cache-size', type=int, default=2048, help='maximum object cache size in MiB (default: 2048)')
+    parser.add_argument('--cache-stats', action='store_true', help='print the object cache statistics and exit')
+    parser.add_argument('--watch', action='store_true', help='keep running and rebuild whenever a source, YAML or address file changes')
+    args = parser.parse_args()
+
+    cache = None
+    if not args.no_cache or args.cache_stats:
+        cache = ObjectCache(args.cache_dir, args.cache_size << 20)
+
+    if args.cache_stats:
+        cache.printStats()
+        return
+
+    if args.projects:
+        # The only positional argument is the version
+        if args.version is None:
+            args.project, args.version = None, args.project
+
+        if args.projects == 'all':
+            projects = findProjects()
+        else:
+            projects = args.projects.split(',')
+    elif args.project:
+        projects = [args.project]
+    else:
+        parser.print_usage()
+        return
+
+    if args.regions == 'all':
+        regions = addrconv.findRegions()
+    elif args.regions:
+        regions = args.regions.split(',')
+    elif args.version:
+        regions = [args.version]
+    else:
+        parser.print_usage()
+        return
+
+    if not projects or not regions:
+        print('No projects or address files found!')
         return
 
     if not os.path.isfile(os.path.join(GHS_PATH, 'gbuild.exe')):
         print("Could not locate MULTI Green Hills Software! Did you set its path?")
         return
 
-    addrconv.loadAddrFile(sys.argv[2])
+    if args.watch:
+        Watcher(projects, regions, args.jobs, cache).run()
+        return
 
-    global linker
-    linker = Linker()
-    buildProject(sys.argv[1])
+    converters = [addrconv.loadAddrFile(region) for region in regions]
 
-    copyOutFiles()
+    try:
+        buildProjects(projects, converters, args.jobs, cache)
+
+    except BuildError as e:
+        print('Build failed!!')
+        print(e)
+        sys.exit(e.code)
+
+    for proj in projects:
+        if len(projects) > 1:
+            copyOutFiles(proj, regions, 'OutProj/%s' %proj)
+        else:
+            copyOutFiles(proj, regions)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,151 @@
+# Output deltas - Describes how the outputs changed since they were last copied,
+# so a console only has to be sent the bytes and patches that changed
+# Every entry holds the new contents of what it changes, so applying a delta twice is harmless
+
+import os, struct
+
+from patches import headerStruct as patchHeaderStruct, recordStruct as patchRecordStruct
+
+
+DELTA_MAGIC = b'CLDL'
+DELTA_VERSION = 1
+
+BYTES, PATCHES = 0, 1
+
+GAP = 16  # Unchanged runs shorter than this are sent along with the changed bytes around them
+
+headerStruct = struct.Struct('>4sHH')  # Magic, version, entry count
+entryStruct = struct.Struct('>B15sII')  # Kind, file name, old size, new size
+rangeStruct = struct.Struct('>II')  # Offset, length, followed by the new bytes
+patchCountsStruct = struct.Struct('>II')  # Removed and changed record counts
+countStruct = struct.Struct('>I')
+addressStruct = struct.Struct('>I')
+
+
+def diffRanges(old, new, block=0x1000):
+    # Returns the (offset, length) ranges of new that differ from old
+    ranges = []
+    common = min(len(old), len(new))
+
+    pos = 0
+    while pos < common:
+        end = min(pos + block, common)
+        if old[pos:end] == new[pos:end]:
+            pos = end
+            continue
+
+        for i in range(pos, end):
+            if old[i] != new[i]:
+                if ranges and i - (ranges[-1][0] + ranges[-1][1]) < GAP:
+                    ranges[-1][1] = i + 1 - ranges[-1][0]
+                else:
+                    ranges.append([i, 1])
+
+        pos = end
+
+    if len(new) > common:
+        if ranges and common - (ranges[-1][0] + ranges[-1][1]) < GAP:
+            ranges[-1][1] = len(new) - ranges[-1][0]
+        else:
+            ranges.append([common, len(new) - common])
+
+    return [tuple(r) for r in ranges]
+
+
+def readPatches(data):
+    # Records of a Patches.hax file, {address: data}
+    records = {}
+    if not data:
+        return records
+
+    count, = patchHeaderStruct.unpack_from(data, 0)
+    pos = patchHeaderStruct.size
+    for i in range(count):
+        size, address = patchRecordStruct.unpack_from(data, pos)
+        pos += patchRecordStruct.size
+        records[address] = bytes(data[pos:pos + size])
+        pos += size
+
+    return records
+
+
+def diffPatches(old, new):
+    # Returns the addresses of the removed records, and the added or changed records
+    old = readPatches(old)
+    new = readPatches(new)
+
+    removed = sorted(address for address in old if address not in new)
+    changed = sorted((address, data) for address, data in new.items() if old.get(address) != data)
+    return removed, changed
+
+
+class DeltaEntry:
+    def __init__(self, name, old, new):
+        self.name = name
+        self.oldSize = len(old)
+        self.newSize = len(new)
+
+        if name.endswith('.hax'):
+            self.kind = PATCHES
+            self.removed, self.changed = diffPatches(old, new)
+        else:
+            self.kind = BYTES
+            self.ranges = [(offset, new[offset:offset + length]) for offset, length in diffRanges(old, new)]
+
+    def describe(self):
+        if self.kind == PATCHES:
+            return '%s: %d patch records changed, %d removed' %(self.name, len(self.changed), len(self.removed))
+
+        return '%s: %d bytes changed in %d ranges' %(self.name, sum(len(data) for offset, data in self.ranges), len(self.ranges))
+
+    def save(self):
+        parts = [entryStruct.pack(self.kind, self.name.encode(), self.oldSize, self.newSize)]
+
+        if self.kind == PATCHES:
+            parts.append(patchCountsStruct.pack(len(self.removed), len(self.changed)))
+            parts += [addressStruct.pack(address) for address in self.removed]
+            for address, data in self.changed:
+                parts.append(patchRecordStruct.pack(len(data), address))
+                parts.append(data)
+
+        else:
+            parts.append(countStruct.pack(len(self.ranges)))
+            for offset, data in self.ranges:
+                parts.append(rangeStruct.pack(offset, len(data)))
+                parts.append(data)
+
+        return b''.join(parts)
+
+
+def writeDelta(filename, entries):
+    with open(filename, 'wb') as f:
+        f.write(headerStruct.pack(DELTA_MAGIC, DELTA_VERSION, len(entries)))
+        for entry in entries:
+            f.write(entry.save())
+
+
+def updateFiles(src, dest, names, deltafile='Delta.bin'):
+    # Copies the files that changed from src to dest, and writes their delta next to them
+    # Returns the delta entries, empty (and an empty delta) if nothing changed
+    entries = []
+    for name in names:
+        with open(os.path.join(src, name), 'rb') as f:
+            new = f.read()
+
+        destfile = os.path.join(dest, name)
+        try:
+            with open(destfile, 'rb') as f:
+                old = f.read()
+        except OSError:
+            old = b''
+
+        if old == new and os.path.isfile(destfile):
+            continue
+
+        entries.append(DeltaEntry(name, old, new))
+        with open(destfile, 'wb') as f:
+            f.write(new)
+
+    # Written even when nothing changed, so an older delta is never taken for the current one
+    writeDelta(os.path.join(dest, deltafile), entries)
+    return entries
@@ -0,0 +1,113 @@
+# Dependency files - Reads the make-style .d files written by gbuild (-MD)
+
+import os, re
+
+
+def splitDeps(text):
+    tokens = []
+    token = ''
+
+    pos = 0
+    text_len = len(text)
+    while pos < text_len:
+        c = text[pos]
+        if c == '\\' and pos + 1 < text_len and text[pos + 1] in ' \t':
+            token += text[pos + 1]  # Escaped whitespace
+            pos += 2
+            continue
+
+        if c in ' \t\n\r':
+            if token:
+                tokens.append(token)
+                token = ''
+        else:
+            token += c
+
+        pos += 1
+
+    if token:
+        tokens.append(token)
+
+    return tokens
+
+
+def parseDepFile(filename):
+    with open(filename) as f:
+        text = f.read()
+
+    # Join continuation lines
+    text = text.replace('\\\r\n', ' ').replace('\\\n', ' ')
+
+    deps = []
+    seen = set()
+    for line in text.splitlines():
+        tokens = splitDeps(line)
+
+        # The target is the first token ending with a colon
+        # (Drive letters such as "C:" are never followed by whitespace)
+        for i, token in enumerate(tokens):
+            if token.endswith(':'):
+                break
+
+        else:
+            continue
+
+        for dep in tokens[i + 1:]:
+            if dep not in seen:
+                seen.add(dep)
+                deps.append(dep)
+
+    return deps
+
+
+_includePattern = re.compile(rb'^[ \t]*(?:\.include|#[ \t]*include)[ \t]*[<"]([^>"\r\n]+)[>"]', re.M)
+
+def scanIncludes(filename, includeDirs=(), root='.'):
+    # Files included by an assembly source (.include or #include), followed recursively
+    # Names are relative to root, like the source; includes that cannot be found are left to the assembler
+    deps = []
+    seen = {os.path.normpath(filename)}
+    todo = [filename]
+    while todo:
+        fn = todo.pop()
+        try:
+            with open(os.path.join(root, fn), 'rb') as f:
+                text = f.read()
+        except OSError:
+            continue
+
+        for match in _includePattern.finditer(text):
+            name = match.group(1).decode(errors='replace')
+            for folder in [os.path.dirname(fn), ''] + list(includeDirs):
+                path = os.path.normpath(os.path.join(folder, name))
+                if os.path.isfile(os.path.join(root, path)):
+                    break
+            else:
+                continue
+
+            if path not in seen:
+                seen.add(path)
+                deps.append(path)
+                todo.append(path)
+
+    return deps
+
+
+class DependencyGraph:
+    def __init__(self):
+        self.deps = {}        # source -> [files it includes, itself included]
+        self.dependents = {}  # file -> {sources that include it}
+
+    def add(self, source, deps):
+        self.remove(source)
+
+        deps = [source] + [dep for dep in deps if os.path.normpath(dep) != os.path.normpath(source)]
+        self.deps[source] = deps
+        for dep in deps:
+            self.dependents.setdefault(os.path.normpath(dep), set()).add(source)
+
+    def remove(self, source):
+        for dep in self.deps.pop(source, []):
+            sources = self.dependents.get(os.path.normpath(dep))
+            if sources:
+                sources.discard(source)
@@ -5,7 +5,13 @@
 # (Hence why program headers are not supported yet)
 # http://wiiubrew.org/wiki/RPL
 
+import io
+import mmap
+import os
 import struct
+import sys
+from array import array
+from itertools import compress
 
 
 def readString(data, offset=0, charWidth=1, encoding='utf-8'):
@@ -16,14 +22,30 @@ def readString(data, offset=0, charWidth=1, encoding='utf-8'):
     return data[offset:end].decode(encoding)
 
 
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+
+
 def round_up(x, y):
     return ((x - 1) | (y - 1)) + 1
 
 
+def endianStructs(format_):
+    # Precompiled little and big endian variants of a format
+    return {endian: struct.Struct(endian + format_) for endian in '<>'}
+
+
 class ELF:
-    class _SectionHeader(struct.Struct):
-        def __init__(self, data, offset, format_, rela):
-            super().__init__(format_)
+    class _SectionHeader:
+        __slots__ = (
+            'struct', 'nameIdx', 'type', 'flags', 'vAddr', 'offset', 'size_', 'link', 'info', 'addrAlign', 'entSize',
+            'isStrTable', 'source', 'rela', '_data', '_relocations', 'name',
+        )
+
+        def __init__(self, data, offset, struct_, rela):
+            self.struct = struct_
 
             (self.nameIdx,
              self.type,
@@ -34,7 +56,7 @@ class ELF:
              self.link,
              self.info,
              self.addrAlign,
-             self.entSize) = self.unpack_from(data, offset)
+             self.entSize) = struct_.unpack_from(data, offset)
 
             self.isStrTable = self.type == 3
             if self.isStrTable:
@@ -43,27 +65,72 @@ class ELF:
 
                 assert data[self.offset] == 0
 
-            self.relocations = []  # Only used for .rela sections
+            # The section data and relocations are only read on first access
+            self.source = data
+            self.rela = rela
+            self._data = None
+            self._relocations = None
 
-            if self.type == 8:
-                self.data = bytearray(self.size_)
+            self.name = 'None'
 
-            else:
-                self.data = bytearray(data[self.offset:self.offset + self.size_])
+        @property
+        def size(self):
+            return self.struct.size
+
+        @property
+        def format(self):
+            return self.struct.format
+
+        @property
+        def data(self):
+            if self._data is None:
+                if self.type == 8:
+                    self._data = bytearray(self.size_)
+
+                elif isinstance(self.source, memoryview) and not self.isStrTable:
+                    self._data = self.source[self.offset:self.offset + self.size_]
 
+                else:
+                    self._data = bytearray(self.source[self.offset:self.offset + self.size_])
+
+            return self._data
+
+        @data.setter
+        def data(self, data):
+            self._data = data
+
+        @property
+        def relocations(self):
+            # Only used for .rela sections
+            if self._relocations is None:
                 if self.type == 4:
-                    self.loadRela(rela, format_[0])
+                    self.loadRela(self.rela, self.format[0])
+                else:
+                    self._relocations = ELF.RelocationTable(self.rela, self.format[0])
 
-            self.name = 'None'
+            return self._relocations
+
+        @relocations.setter
+        def relocations(self, relocations):
+            # Lists of Rela records are copied into a table
+            if not isinstance(relocations, ELF.RelocationTable):
+                table = ELF.RelocationTable(self.rela, self.format[0])
+                for rela in relocations:
+                    table.append(rela)
+                relocations = table
+
+            self._relocations = relocations
 
         def loadRela(self, rela, endian):
-            count = len(self.data) // self.entSize
-            self.relocations = []
-            for i in range(count):
-                self.relocations.append(rela(self.data, i * self.entSize, endian))
+            self._relocations = ELF.RelocationTable(rela, endian, self.data, self.entSize)
+
+        def release(self):
+            if isinstance(self._data, memoryview):
+                self._data.release()
+                self._data = None
 
         def saveRela(self):
-            self.data = bytearray(b''.join([rela.save() for rela in self.relocations]))
+            self.data = bytearray(self.relocations.tobytes())
 
         def readName(self, shStrTable):
             if self.nameIdx:
@@ -109,17 +176,16 @@ class ELF:
             if self.type == 8:
                 offset = 0
 
-            elif self.type == 4:
+            elif self.type == 4 and self._relocations is not None:
                 self.saveRela()
 
-            return struct.pack(
-                self.format,
+            return self.struct.pack(
                 self.nameIdx,
                 self.type,
                 self.flags,
                 self.vAddr,
                 offset,
-                len(self.data),
+                self.size_ if self.type == 8 else len(self.data),
                 self.link,
                 self.info,
                 self.addrAlign,
@@ -127,48 +193,317 @@ class ELF:
             )
 
     class SectionHeader32(_SectionHeader):
+        __slots__ = ()
+        structs = endianStructs('10I')
+
         def __init__(self, data, offset, endian):
-            super().__init__(data, offset, '%s10I' % endian, ELF.Rela32)
+            super().__init__(data, offset, self.structs[endian], ELF.Rela32)
 
     class SectionHeader64(_SectionHeader):
+        __slots__ = ()
+        structs = endianStructs('2I4Q2I2Q')
+
         def __init__(self, data, offset, endian):
-            super().__init__(data, offset, '%s2I4Q2I2Q' % endian, ELF.Rela64)
+            super().__init__(data, offset, self.structs[endian], ELF.Rela64)
 
-    class _Rela(struct.Struct):
-        def __init__(self, data, offset, format_):
-            super().__init__(format_)
+    class _Rela:
+        __slots__ = ('struct', 'offset', 'info', 'addend')
+        structs = None
+        typecodes = None  # Array types of the offset/info and addend fields
+        symShift = None
+
+        def __init__(self, data, offset, endian):
+            self.struct = self.structs[endian]
 
             (self.offset,
              self.info,
-             self.addend) = self.unpack_from(data, offset)
+             self.addend) = self.struct.unpack_from(data, offset)
+
+        @classmethod
+        def fromValues(cls, endian, offset, info, addend):
+            rela = cls.__new__(cls)
+            rela.struct = cls.structs[endian]
+            rela.offset = offset
+            rela.info = info
+            rela.addend = addend
+            return rela
+
+        @property
+        def type(self):
+            return self.info & ((1 << self.symShift) - 1)
+
+        @property
+        def symbol(self):
+            return self.info >> self.symShift
 
         def save(self):
-            return struct.pack(
-                self.format,
+            return self.struct.pack(
                 self.offset,
                 self.info,
                 self.addend,
             )
 
     class Rela32(_Rela):
-        def __init__(self, data, offset, endian):
-            super().__init__(data, offset, '%s2Ii' % endian)
+        __slots__ = ()
+        structs = endianStructs('2Ii')
+        typecodes = ('I', 'i')
+        symShift = 8
 
     class Rela64(_Rela):
-        def __init__(self, data, offset, endian):
-            super().__init__(data, offset, '%s2Qq' % endian)
+        __slots__ = ()
+        structs = endianStructs('2Qq')
+        typecodes = ('Q', 'q')
+        symShift = 32
 
-    class Header(struct.Struct):
-        class Identifier(struct.Struct):
-            def __init__(self, data):
-                super().__init__('=4s5B7x')
+    class RelaRef:
+        # An entry of a RelocationTable, setting its fields updates the table
+        __slots__ = ('table', 'index')
+
+        def __init__(self, table, index):
+            self.table = table
+            self.index = index
+
+        @property
+        def struct(self):
+            return self.table.rela.structs[self.table.endian]
+
+        @property
+        def offset(self):
+            return self.table.offsets[self.index]
+
+        @offset.setter
+        def offset(self, offset):
+            self.table.offsets[self.index] = offset
+
+        @property
+        def info(self):
+            return self.table.infos[self.index]
+
+        @info.setter
+        def info(self, info):
+            self.table.infos[self.index] = info
+
+        @property
+        def addend(self):
+            return self.table.addends[self.index]
+
+        @addend.setter
+        def addend(self, addend):
+            self.table.addends[self.index] = addend
+
+        @property
+        def type(self):
+            return self.info & ((1 << self.table.rela.symShift) - 1)
+
+        @property
+        def symbol(self):
+            return self.info >> self.table.rela.symShift
+
+        def save(self):
+            return self.struct.pack(
+                self.offset,
+                self.info,
+                self.addend,
+            )
+
+    class RelocationTable:
+        # The entries of a .rela section, stored as one array per field
+        # Entries can still be indexed, iterated, assigned and deleted like a list of Rela records,
+        # and the records returned write their changes back to the table
+
+        def __init__(self, rela, endian, data=b'', entSize=None):
+            self.rela = rela
+            self.endian = endian
+
+            uintF, intF = rela.typecodes
+            self.offsets = array(uintF)
+            self.infos = array(uintF)
+            self.addends = array(intF)
+
+            struct_ = rela.structs[endian]
+            entSize = entSize or struct_.size
+            count = len(data) // entSize
+
+            if entSize != struct_.size:
+                for i in range(count):
+                    offset, info, addend = struct_.unpack_from(data, i * entSize)
+                    self.offsets.append(offset)
+                    self.infos.append(info)
+                    self.addends.append(addend)
+
+            elif count:
+                # The three fields have the same width, so the table is read as a single array
+                raw = array(uintF)
+                raw.frombytes(data[:count * entSize])
+                if self.swapped():
+                    raw.byteswap()
+
+                self.offsets = raw[0::3]
+                self.infos = raw[1::3]
+                self.addends.frombytes(raw[2::3].tobytes())
+
+        def swapped(self):
+            return (self.endian == '<') != (sys.byteorder == 'little')
+
+        def __len__(self):
+            return len(self.offsets)
+
+        def __getitem__(self, i):
+            if isinstance(i, slice):
+                return [ELF.RelaRef(self, j) for j in range(len(self))[i]]
+
+            return ELF.RelaRef(self, range(len(self))[i])
+
+        def __setitem__(self, i, rela):
+            self.offsets[i] = rela.offset
+            self.infos[i] = rela.info
+            self.addends[i] = rela.addend
+
+        def __iter__(self):
+            for i in range(len(self)):
+                yield ELF.RelaRef(self, i)
+
+        def __delitem__(self, i):
+            del self.offsets[i]
+            del self.infos[i]
+            del self.addends[i]
+
+        def append(self, rela):
+            self.offsets.append(rela.offset)
+            self.infos.append(rela.info)
+            self.addends.append(rela.addend)
+
+        def types(self):
+            mask = (1 << self.rela.symShift) - 1
+            return [info & mask for info in self.infos]
+
+        def symbols(self):
+            shift = self.rela.symShift
+            return [info >> shift for info in self.infos]
+
+        def match(self, types=None, symbols=None, offsets=None):
+            # Returns which entries have one of the given types and symbol indices
+            # and an offset in the given (start, end) range
+            selected = [True] * len(self)
+
+            if types is not None:
+                types = set(types)
+                selected = [s and t in types for s, t in zip(selected, self.types())]
+
+            if symbols is not None:
+                symbols = set(symbols)
+                selected = [s and sym in symbols for s, sym in zip(selected, self.symbols())]
+
+            if offsets is not None:
+                start, end = offsets
+                selected = [s and start <= offset < end for s, offset in zip(selected, self.offsets)]
+
+            return selected
+
+        def keep(self, selected):
+            uintF, intF = self.rela.typecodes
+            self.offsets = array(uintF, compress(self.offsets, selected))
+            self.infos = array(uintF, compress(self.infos, selected))
+            self.addends = array(intF, compress(self.addends, selected))
+
+        def select(self, **filters):
+            table = ELF.RelocationTable(self.rela, self.endian)
+            table.offsets, table.infos, table.addends = self.offsets, self.infos, self.addends
+            table.keep(self.match(**filters))
+            return table
+
+        def remove(self, **filters):
+            # Removes the matching entries and returns how many there were
+            selected = self.match(**filters)
+            count = selected.count(True)
+            if count:
+                self.keep([not s for s in selected])
+
+            return count
+
+        def tobytes(self):
+            count = len(self)
+            if not count:
+                return b''
+
+            uintF = self.rela.typecodes[0]
+            raw = array(uintF, bytes(3 * count * self.offsets.itemsize))
+            raw[0::3] = self.offsets
+            raw[1::3] = self.infos
+            raw[2::3] = array(uintF, self.addends.tobytes())
+            if self.swapped():
+                raw.byteswap()
+
+            return raw.tobytes()
+
+    class _Symbol:
+        __slots__ = ('nameIdx', 'value', 'size', 'info', 'other', 'shndx', 'name', 'section')
+        structs = None
+
+        @classmethod
+        def loadTable(cls, data, entSize, endian):
+            struct_ = cls.structs[endian]
+            if entSize != struct_.size:
+                return [cls.fromValues(struct_.unpack_from(data, i * entSize)) for i in range(len(data) // entSize)]
+
+            return [cls.fromValues(values) for values in struct_.iter_unpack(data[:len(data) - len(data) % entSize])]
+
+        @property
+        def bind(self):
+            return self.info >> 4
+
+        @property
+        def type(self):
+            return self.info & 0xF
+
+        @property
+        def isDefined(self):
+            # Not undefined, absolute, common or otherwise reserved
+            return 0 < self.shndx < 0xFF00
+
+    class Symbol32(_Symbol):
+        __slots__ = ()
+        structs = endianStructs('3I2BH')
+
+        @classmethod
+        def fromValues(cls, values):
+            symbol = cls.__new__(cls)
+            (symbol.nameIdx,
+             symbol.value,
+             symbol.size,
+             symbol.info,
+             symbol.other,
+             symbol.shndx) = values
+            return symbol
+
+    class Symbol64(_Symbol):
+        __slots__ = ()
+        structs = endianStructs('I2BH2Q')
+
+        @classmethod
+        def fromValues(cls, values):
+            symbol = cls.__new__(cls)
+            (symbol.nameIdx,
+             symbol.info,
+             symbol.other,
+             symbol.shndx,
+             symbol.value,
+             symbol.size) = values
+            return symbol
+
+    class Header:
+        class Identifier:
+            __slots__ = ('magic', 'class_', 'enc', 'version', 'osAbi', 'abiVersion')
+            struct = struct.Struct('=4s5B7x')
+            size = struct.size
 
+            def __init__(self, data):
                 (self.magic,
                  self.class_,
                  self.enc,
                  self.version,
                  self.osAbi,
-                 self.abiVersion) = self.unpack_from(data, 0)
+                 self.abiVersion) = self.struct.unpack_from(data, 0)
 
                 self.checkIdentifier()
 
@@ -179,8 +514,7 @@ class ELF:
                 assert self.version == 1
 
             def save(self):
-                return struct.pack(
-                    '=4s5B7x',
+                return self.struct.pack(
                     self.magic,
                     self.class_,
                     self.enc,
@@ -189,12 +523,20 @@ class ELF:
                     self.abiVersion,
                 )
 
+        __slots__ = (
+            'ident', 'endian', 'struct', 'type', 'machine', 'version', 'entry', 'progHeadOff', 'secHeadOff', 'flags',
+            'size_', 'progHeadEntSize', 'progHeadNum', 'secHeadEntSize', 'secHeadNum', 'namesSecHeadIdx',
+        )
+
+        structs = {
+            1: endianStructs('2HI3II6H'),
+            2: endianStructs('2HI3QI6H'),
+        }
+
         def __init__(self, data):
             self.ident = self.Identifier(data); pos = self.ident.size
             self.endian = '<' if self.ident.enc == 1 else '>'
-            uintF = 'I' if self.ident.class_ == 1 else 'Q'
-
-            super().__init__('%s2HI3%sI6H' % (self.endian, uintF))
+            self.struct = self.structs[self.ident.class_][self.endian]
 
             (self.type,
              self.machine,
@@ -208,10 +550,14 @@ class ELF:
              self.progHeadNum,
              self.secHeadEntSize,
              self.secHeadNum,
-             self.namesSecHeadIdx) = self.unpack_from(data, pos)
+             self.namesSecHeadIdx) = self.struct.unpack_from(data, pos)
 
             self.checkHeader()
 
+        @property
+        def size(self):
+            return self.struct.size
+
         def checkHeader(self):
             assert self.version == 1
             assert self.size_ == self.size + self.ident.size
@@ -258,8 +604,7 @@ class ELF:
             outBuffer = bytearray(self.ident.save())
 
             size = self.size + self.ident.size
-            outBuffer += struct.pack(
-                self.format,
+            outBuffer += self.struct.pack(
                 self.type,
                 self.machine,
                 self.version,
@@ -277,9 +622,23 @@ class ELF:
 
             return outBuffer
 
-    def __init__(self, file):
-        with open(file, "rb") as inf:
-            inb = inf.read()
+    def __init__(self, file, lazy=False, writable=False):
+        # In lazy mode the file is mapped instead of read,
+        # and section data is handed out as views into the mapping
+        # (Call close() once done with them, or use the ELF as a context manager)
+        # A writable mapping allows editing the file in place with saveInPlace()
+        self.file = None
+        self.map = None
+        self.view = None
+
+        if lazy or writable:
+            self.file = open(file, "r+b" if writable else "rb")
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+            self.view = inb = memoryview(self.map)
+
+        else:
+            with open(file, "rb") as inf:
+                inb = inf.read()
 
         self.header = self.Header(inb); pos = self.header.size_
 
@@ -306,12 +665,36 @@ class ELF:
 
                 self.secHeadEnts.append(entry); pos += self.header.secHeadEntSize
 
+        self.symbols = None
+
+        self.sectionsByName = {}
         for entry in self.secHeadEnts:
             if self.shStrTable:
                 entry.readName(self.shStrTable)
 
+            self.sectionsByName.setdefault(entry.name, entry)
+
         #self.printInfo()
 
+    def close(self):
+        if self.map is None:
+            return
+
+        # The mapping can only be closed once no views into it are left
+        for entry in self.secHeadEnts:
+            entry.release()
+
+        self.view.release()
+        self.map.close()
+        self.file.close()
+        self.view = self.map = self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
     def printInfo(self):
         self.header.printInfo()
 
@@ -320,32 +703,184 @@ class ELF:
             entry.printInfo()
 
     def getSectionByName(self, name):
-        for entry in self.secHeadEnts:
-            if entry.name == name:
-                return entry
+        return self.sectionsByName.get(name)
+
+    def getSymbols(self):
+        # Symbols of the first symbol table, with their names and sections resolved
+        if self.symbols is not None:
+            return self.symbols
+
+        self.symbols = []
+        for symTable in self.secHeadEnts:
+            if symTable.type == 2:
+                break
+
+        else:
+            return self.symbols
+
+        symbol = ELF.Symbol32 if self.header.ident.class_ == 1 else ELF.Symbol64
+        strTable = self.secHeadEnts[symTable.link].data
+
+        self.symbols = symbol.loadTable(symTable.data, symTable.entSize, self.header.endian)
+        for symbol in self.symbols:
+            symbol.name = readString(strTable, symbol.nameIdx) if symbol.nameIdx else ''
+            symbol.section = self.secHeadEnts[symbol.shndx] if symbol.isDefined and symbol.shndx < len(self.secHeadEnts) else None
+
+        return self.symbols
+
+    def getSymbolsByName(self):
+        # Later symbols win, so globals take precedence over locals of the same name
+        return {symbol.name: symbol for symbol in self.getSymbols() if symbol.name}
+
+    def saveInPlace(self):
+        # Writes the changed relocation tables back into the mapped file
+        # Only the .rela sections and their section headers are touched,
+        # so tables can only shrink; the space left over is zeroed
+        assert self.map is not None and not self.map.closed
+
+        changed = 0
+        for i, entry in enumerate(self.secHeadEnts):
+            if entry.type != 4 or entry._relocations is None:
+                continue
+
+            data = entry._relocations.tobytes()
+            if len(data) > entry.size_:
+                raise ValueError("Relocations of section '%s' do not fit in place" % entry.name)
+
+            end = entry.offset + entry.size_
+            if self.map[entry.offset:end] == data:
+                continue
+
+            entry.release()
+            self.map[entry.offset:entry.offset + len(data)] = data
+            self.map[entry.offset + len(data):end] = bytes(end - entry.offset - len(data))
+
+            entry.size_ = len(data)
+            entry.struct.pack_into(
+                self.map,
+                self.header.secHeadOff + i * self.header.secHeadEntSize,
+                entry.nameIdx,
+                entry.type,
+                entry.flags,
+                entry.vAddr,
+                entry.offset,
+                entry.size_,
+                entry.link,
+                entry.info,
+                entry.addrAlign,
+                entry.entSize
+            )
 
-        return None
+            changed += 1
+
+        return changed
 
     def save(self):
         self.header.type = 0xFE01
         return self.saveRel()
 
-    def saveRel(self):
-        outBuffer = bytearray(self.header.save(self.secHeadEnts, self.secHeadEnts.index(self.shStrTable)))
+    def saveParts(self):
+        # Lays out the file and returns its pieces in order, without copying the section data
+        header = self.header.save(self.secHeadEnts, self.secHeadEnts.index(self.shStrTable))
 
-        align = round_up(len(outBuffer), 0x10) - len(outBuffer)
-        outBuffer += b'\0' * align
+        align = round_up(len(header), 0x10) - len(header)
+        parts = [header, b'\0' * align]
 
         # TODO: Program headers
         offset = self.header.size + self.header.ident.size + align + len(self.secHeadEnts) * self.secHeadEnts[0].size
-        outBuffer += self.secHeadEnts[0].save(0)
+        parts.append(self.secHeadEnts[0].save(0))
         for entry in self.secHeadEnts[1:]:
-            outBuffer += entry.save(offset)
+            parts.append(entry.save(offset))
             if entry.type != 8:
                 offset += len(entry.data)
 
         for entry in self.secHeadEnts:
             if entry.type != 8:
-                outBuffer += entry.data
+                parts.append(entry.data)
+
+        return parts
+
+    def saveRel(self):
+        return bytearray(b''.join(self.saveParts()))
+
+    def saveTo(self, file):
+        # Streams the relocatable file to a file object and returns its size
+        # Unbuffered files (open(..., 'wb', buffering=0)) are written with vectored writes
+        parts = [part for part in self.saveParts() if len(part)]
+        total = sum(len(part) for part in parts)
+
+        if isinstance(file, io.FileIO) and hasattr(os, 'writev'):
+            fd = file.fileno()
+            while parts:
+                written = os.writev(fd, parts[:IOV_MAX])
+
+                # Drop what was written, keeping the rest of a partially written piece
+                while parts and written >= len(parts[0]):
+                    written -= len(parts.pop(0))
+                if written:
+                    parts[0] = memoryview(parts[0])[written:]
+
+        else:
+            for part in parts:
+                file.write(part)
+
+        return total
+
+
+def copyRange(fdIn, fdOut, offset, size):
+    # Copies part of a file into another one inside the kernel, where supported
+    # Returns how much was copied, which may be less than asked
+    if hasattr(os, 'copy_file_range'):
+        copy = lambda count, offset: os.copy_file_range(fdIn, fdOut, count, offset)
+
+    elif hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+        copy = lambda count, offset: os.sendfile(fdOut, fdIn, offset, count)
+
+    else:
+        return 0
+
+    done = 0
+    try:
+        while done < size:
+            copied = copy(size - done, offset + done)
+            if not copied:
+                break
+            done += copied
+
+    except OSError:
+        pass
+
+    return done
+
+
+def extractSections(file, outputs):
+    # Concatenates sections of an ELF file into other files, e.g. [('Code.bin', ['.text'])]
+    # Only the section header table is parsed, and the data is copied straight from the file
+    # Returns where each section was written: {output: [(name, offset in output, size)]}
+    layouts = {}
+    with ELF(file, lazy=True) as obj:
+        fdIn = obj.file.fileno()
+
+        for output, names in outputs:
+            layout = layouts[output] = []
+            pos = 0
+
+            with open(output, 'wb', buffering=0) as outf:
+                for name in names:
+                    section = obj.getSectionByName(name)
+                    if not section:
+                        continue
+
+                    if section.type == 8:
+                        outf.write(bytes(section.size_))
+
+                    else:
+                        copied = copyRange(fdIn, outf.fileno(), section.offset, section.size_)
+                        if copied < section.size_:
+                            with section.data[copied:] as rest:
+                                outf.write(rest)
+
+                    layout.append((name, pos, section.size_))
+                    pos += section.size_
 
-        return outBuffer
+    return layouts
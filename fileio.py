@@ -0,0 +1,31 @@
+# Atomic writes - Cache and manifest files are written to a temporary file first,
+# which then replaces them, so concurrent builds never see a partial file
+
+import contextlib, os, threading
+
+
+def tempName(filename):
+    # Unique to the process and thread, next to the file so it can be renamed over it
+    return '%s.%d.%d.tmp' %(filename, os.getpid(), threading.get_ident())
+
+
+def removeTemp(temp):
+    try:
+        os.remove(temp)
+    except OSError:
+        pass
+
+
+@contextlib.contextmanager
+def atomicFile(filename, mode='wb'):
+    # The file only replaces filename once the block completes, and is removed if it raises
+    temp = tempName(filename)
+    try:
+        with open(temp, mode) as f:
+            yield f
+
+        os.replace(temp, filename)
+
+    except BaseException:
+        removeTemp(temp)
+        raise
@@ -0,0 +1,101 @@
+# Build manifest - Records the inputs of every build phase
+# so unchanged phases can be skipped on the next build
+
+import hashlib, json, os, threading
+
+from fileio import atomicFile
+
+
+MANIFEST_VERSION = 1
+
+
+def hashFile(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        while True:
+            chunk = f.read(0x100000)
+            if not chunk:
+                break
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+class Manifest:
+    def __init__(self, filename, root='.'):
+        self.filename = filename
+        self.root = root  # Input and output names are relative to this
+        self.phases = {}
+        self.hashes = {}  # filename -> (modification stamp, hash)
+        self.lock = threading.Lock()
+
+        if os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    manifest = json.load(f)
+
+            except ValueError:
+                manifest = {}
+
+            if manifest.get('version') == MANIFEST_VERSION:
+                self.phases = manifest.get('phases', {})
+
+    def hash(self, filename):
+        # Files are only hashed again once they were modified,
+        # so a manifest kept alive between builds stays cheap to check
+        path = os.path.join(self.root, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        cached = self.hashes.get(filename)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, hashFile(path))
+            self.hashes[filename] = cached
+
+        return cached[1]
+
+    def invalidate(self, filenames):
+        for filename in filenames:
+            self.hashes.pop(filename, None)
+
+    def digest(self, inputs, key=None):
+        digest = {'files': {fn: self.hash(fn) for fn in inputs}}
+        if key is not None:
+            digest['key'] = key
+
+        return digest
+
+    def isUpToDate(self, phase, inputs, outputs, key=None):
+        entry = self.phases.get(phase)
+        if entry is None:
+            return False
+
+        for fn in outputs:
+            if not os.path.isfile(os.path.join(self.root, fn)):
+                return False
+
+        return entry == self.digest(inputs, key)
+
+    def record(self, phase, inputs, key=None, save=True, rehash=True):
+        # Callers recording many phases at once can invalidate their inputs once beforehand
+        if rehash:
+            self.invalidate(inputs)
+        digest = self.digest(inputs, key)
+        with self.lock:
+            self.phases[phase] = digest
+        if save:
+            self.save()
+
+    def forget(self, phase):
+        with self.lock:
+            forgotten = self.phases.pop(phase, None) is not None
+        if forgotten:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            with atomicFile(self.filename, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'phases': self.phases}, f, indent=1, sort_keys=True)
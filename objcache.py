@@ -0,0 +1,171 @@
+# Object cache - Shares compiled objects between projects, regions and clean checkouts
+# Objects are stored under a hash of the preprocessed source and the full compiler flags
+
+import hashlib, json, os, re, shutil, threading
+
+from fileio import atomicFile
+
+
+DEFAULT_SIZE = 2 << 30  # 2 GiB
+
+lineMarker = re.compile(rb'^[ \t]*#[ \t]*(?:line[ \t]+)?\d+[ \t]+"((?:[^"\\]|\\.)*)"', re.M)
+
+
+def defaultCacheDir():
+    path = os.environ.get('CLPC_CACHE_DIR')
+    if path:
+        return path
+
+    return os.path.join(os.path.expanduser('~'), '.clpc_cache')
+
+
+def includedFiles(preprocessed):
+    files = []
+    seen = set()
+    for match in lineMarker.finditer(preprocessed):
+        fn = match.group(1).decode(errors='replace').replace('\\\\', '\\')
+        if fn.startswith('<') or fn in seen:
+            continue
+
+        seen.add(fn)
+        files.append(fn)
+
+    return files
+
+
+def writeDepFile(filename, target, deps):
+    deps = [dep.replace(' ', '\\ ') for dep in deps]
+    with open(filename, 'w') as f:
+        f.write('%s: %s\n' %(target, ' \\\n  '.join(deps)))
+
+
+class ObjectCache:
+    def __init__(self, path=None, maxSize=DEFAULT_SIZE):
+        self.path = path or defaultCacheDir()
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, preprocessed, flags):
+        h = hashlib.sha256()
+        h.update(flags.encode())
+        h.update(b'\0')
+
+        # Line markers hold the absolute paths of the checkout, which must not affect the key
+        h.update(lineMarker.sub(b'', preprocessed))
+        return h.hexdigest()
+
+    def entryPath(self, key):
+        return os.path.join(self.path, key[:2], key[2:] + '.o')
+
+    def lookup(self, key, obj):
+        entry = self.entryPath(key)
+        try:
+            shutil.copyfile(entry, obj)
+
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return False
+
+        # The modification time is the last access for the LRU eviction
+        try:
+            os.utime(entry)
+        except OSError:
+            pass
+
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, obj):
+        entry = self.entryPath(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        # Other build processes may use the cache at the same time
+        with open(obj, 'rb') as src, atomicFile(entry) as f:
+            shutil.copyfileobj(src, f)
+
+    def entries(self):
+        entries = []
+        for folder in os.listdir(self.path):
+            folder = os.path.join(self.path, folder)
+            if not os.path.isdir(folder):
+                continue
+
+            for fn in os.listdir(folder):
+                if not fn.endswith('.o'):
+                    continue
+
+                fn = os.path.join(folder, fn)
+                try:
+                    stat = os.stat(fn)
+                except OSError:
+                    continue
+
+                entries.append((stat.st_mtime, stat.st_size, fn))
+
+        return entries
+
+    def size(self):
+        return sum(size for mtime, size, fn in self.entries())
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for mtime, size, fn in entries)
+        if total <= self.maxSize:
+            return 0
+
+        # Least recently used first
+        entries.sort()
+
+        removed = 0
+        for mtime, size, fn in entries:
+            if total <= self.maxSize:
+                break
+
+            try:
+                os.remove(fn)
+            except OSError:
+                continue
+
+            total -= size
+            removed += 1
+
+        return removed
+
+    def loadStats(self):
+        try:
+            with open(os.path.join(self.path, 'stats.json')) as f:
+                return json.load(f)
+
+        except (OSError, ValueError):
+            return {'hits': 0, 'misses': 0}
+
+    def saveStats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            self.hits = self.misses = 0
+
+            stats = self.loadStats()
+            stats['hits'] = stats.get('hits', 0) + hits
+            stats['misses'] = stats.get('misses', 0) + misses
+
+            with atomicFile(os.path.join(self.path, 'stats.json'), 'w') as f:
+                json.dump(stats, f)
+
+        return hits, misses
+
+    def printStats(self):
+        stats = self.loadStats()
+        total = stats['hits'] + stats['misses']
+
+        print('Object cache:', self.path)
+        print('Hits: %d' %stats['hits'])
+        print('Misses: %d' %stats['misses'])
+        if total:
+            print('Hit rate: %.1f%%' %(stats['hits'] * 100 / total))
+        print('Size: %.1f / %.1f MiB' %(self.size() / 0x100000, self.maxSize / 0x100000))
@@ -0,0 +1,129 @@
+# Patches - Builds Patches.hax from the patches of every hook
+# Patches are sorted and contiguous ones are merged into a single record,
+# so CafeLoader has fewer and larger records to apply at boot
+
+import bisect, heapq, struct
+
+
+MAX_RECORD = 0xFFFC  # Record sizes are 16-bit, split records stay word aligned
+
+headerStruct = struct.Struct('>H')  # Record count
+recordStruct = struct.Struct('>HI')  # Size, address, followed by the data
+
+
+def coalescePatches(patches):
+    # patches: [(address, data)] in the order they are applied
+    # Returns the merged [(address, data)] records, sorted by address
+    # Where patches overlap, the one applied last wins, as if they were applied one by one
+    runs = []  # [start, end, [indices of the patches]]
+    for i in sorted(range(len(patches)), key=lambda i: patches[i][0]):
+        address, data = patches[i]
+        if not data:
+            continue
+
+        end = address + len(data)
+        if runs and address <= runs[-1][1]:
+            runs[-1][1] = max(runs[-1][1], end)
+            runs[-1][2].append(i)
+        else:
+            runs.append([address, end, [i]])
+
+    records = []
+    for start, end, members in runs:
+        if len(members) == 1:
+            run = patches[members[0]][1]
+        else:
+            run = bytearray(end - start)
+            for i in sorted(members):
+                address, data = patches[i]
+                run[address - start:address - start + len(data)] = data
+
+        for offset in range(0, len(run), MAX_RECORD):
+            records.append((start + offset, bytes(run[offset:offset + MAX_RECORD])))
+
+    return records
+
+
+def packPatches(records):
+    if len(records) > 0xFFFF:
+        raise ValueError("Too many patch records: %d" %len(records))
+
+    buffer = bytearray(headerStruct.size + sum(recordStruct.size + len(data) for address, data in records))
+    headerStruct.pack_into(buffer, 0, len(records))
+
+    pos = headerStruct.size
+    for address, data in records:
+        recordStruct.pack_into(buffer, pos, len(data), address)
+        pos += recordStruct.size
+        buffer[pos:pos + len(data)] = data
+        pos += len(data)
+
+    return buffer
+
+
+class Patch:
+    __slots__ = ('address', 'data', 'module', 'hook')
+
+    def __init__(self, address, data, module=None, hook=None):
+        self.address = address
+        self.data = data
+        self.module = module  # Name of the module the hook comes from
+        self.hook = hook  # The hook entry of the module YAML
+
+    @property
+    def end(self):
+        return self.address + len(self.data)
+
+    def __str__(self):
+        if self.hook is None:
+            return 'patch at %08x' %self.address
+
+        return "module '%s', %s hook at %s" %(self.module, self.hook['type'], self.hook['addr'])
+
+
+class PatchIndex:
+    # Interval index over the bytes written by every patch
+
+    def __init__(self, patches):
+        self.patches = sorted((patch for patch in patches if patch.data), key=lambda patch: (patch.address, patch.end))
+        self.starts = [patch.address for patch in self.patches]
+
+        # Furthest end of the patches up to each position, to skip those ending before a range
+        self.maxEnds = []
+        maxEnd = 0
+        for patch in self.patches:
+            maxEnd = max(maxEnd, patch.end)
+            self.maxEnds.append(maxEnd)
+
+    def query(self, start, end):
+        # Patches touching any byte in [start, end)
+        first = bisect.bisect_right(self.maxEnds, start)
+        last = bisect.bisect_left(self.starts, end)
+        return [patch for patch in self.patches[first:last] if patch.end > start]
+
+    def overlaps(self):
+        # Yields every (patch, patch, identical) pair writing some of the same bytes,
+        # identical being whether they write the same values there
+        active = []  # (end, position, patch) of the patches not ended yet
+        for i, patch in enumerate(self.patches):
+            while active and active[0][0] <= patch.address:
+                heapq.heappop(active)
+
+            for end, j, other in sorted(active, key=lambda entry: entry[1]):
+                start = patch.address
+                end = min(end, patch.end)
+                identical = other.data[start - other.address:end - other.address] == patch.data[:end - start]
+                yield other, patch, identical
+
+            heapq.heappush(active, (patch.end, i, patch))
+
+    def check(self):
+        # Returns the conflicting pairs, and prints a warning for duplicated ones
+        conflicts = []
+        for first, second, identical in self.overlaps():
+            if identical:
+                print('Warning: %s duplicates %s' %(second, first))
+            else:
+                conflicts.append((first, second))
+
+        return conflicts
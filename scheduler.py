@@ -0,0 +1,206 @@
+# Build scheduler - Runs build steps as a dependency graph
+# Steps declare the files (or other named results) they read and write,
+# and every step whose inputs are ready runs concurrently with the others
+
+import asyncio, concurrent.futures, os
+
+
+_processPool = None
+
+
+def processPool():
+    # Shared by every graph, and kept alive between builds in watch mode
+    global _processPool
+    if _processPool is None:
+        _processPool = concurrent.futures.ProcessPoolExecutor()
+
+    return _processPool
+
+
+class BuildError(Exception):
+    def __init__(self, message, code=1):
+        super().__init__(message)
+        self.code = code
+
+
+class Step:
+    def __init__(self, name, action, inputs, outputs, after):
+        self.name = name
+        self.action = action  # A command line, a function or a coroutine function taking the graph
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.after = list(after)  # Names of steps that must finish first
+        self.deps = []
+
+
+class BuildGraph:
+    def __init__(self, jobs=None, name=None, cwd=None):
+        self.name = name  # Shown in the output when several graphs run at once
+        self.cwd = cwd  # Working directory of the commands
+        self.steps = []
+        self.jobs = jobs or os.cpu_count() or 1
+        self.semaphore = None
+
+    def add(self, name, action, inputs=(), outputs=(), after=()):
+        step = Step(name, action, inputs, outputs, after)
+        self.steps.append(step)
+        return step
+
+    def resolve(self):
+        producers = {}
+        names = {}
+        for step in self.steps:
+            if step.name in names:
+                raise BuildError("Duplicate build step '%s'" %step.name)
+            names[step.name] = step
+
+            for output in step.outputs:
+                output = os.path.normpath(output)
+                if output in producers:
+                    raise BuildError("'%s' is produced by both '%s' and '%s'" %(output, producers[output].name, step.name))
+                producers[output] = step
+
+        for step in self.steps:
+            step.deps = []
+            for input_ in step.inputs:
+                dep = producers.get(os.path.normpath(input_))
+                if dep is not None and dep is not step and dep not in step.deps:
+                    step.deps.append(dep)
+
+            for name in step.after:
+                if name not in names:
+                    raise BuildError("Build step '%s' depends on unknown step '%s'" %(step.name, name))
+                if names[name] not in step.deps:
+                    step.deps.append(names[name])
+
+        # Reject cycles before starting anything
+        visited = {}
+        def visit(step):
+            state = visited.get(step)
+            if state == 1:
+                raise BuildError("Dependency cycle involving '%s'" %step.name)
+            if state is None:
+                visited[step] = 1
+                for dep in step.deps:
+                    visit(dep)
+                visited[step] = 2
+
+        for step in self.steps:
+            visit(step)
+
+    def prefix(self, step):
+        if self.name:
+            return '[%s %s] ' %(self.name, step)
+
+        return '[%s] ' %step
+
+    async def runCommand(self, cmd, prefix='', cwd=None):
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_shell(
+                cmd, cwd=cwd or self.cwd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+            )
+
+            try:
+                while True:
+                    line = await proc.stdout.readline()
+                    if not line:
+                        break
+                    print(prefix + line.decode(errors='replace').rstrip())
+
+                return await proc.wait()
+
+            except asyncio.CancelledError:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+
+    async def captureCommand(self, cmd, cwd=None):
+        # Runs a command quietly and returns its exit code and standard output
+        async with self.semaphore:
+            proc = await asyncio.create_subprocess_shell(
+                cmd, cwd=cwd or self.cwd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+
+            try:
+                output, _ = await proc.communicate()
+                return proc.returncode, output
+
+            except asyncio.CancelledError:
+                if proc.returncode is None:
+                    proc.kill()
+                    await proc.wait()
+                raise
+
+    async def runFunction(self, func, *args):
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def runProcess(self, func, *args):
+        # For CPU bound work; func and its arguments must be picklable
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(processPool(), func, *args)
+
+    async def runStep(self, step, tasks):
+        for dep in step.deps:
+            await tasks[dep]
+
+        if isinstance(step.action, str):
+            error = await self.runCommand(step.action, self.prefix(step.name))
+            if error:
+                raise BuildError("'%s' failed with error code %i" %(step.name, error), error)
+
+        elif asyncio.iscoroutinefunction(step.action):
+            await step.action(self)
+
+        else:
+            await self.runFunction(step.action)
+
+    async def runAsync(self, semaphore=None):
+        self.resolve()
+        self.semaphore = semaphore or asyncio.Semaphore(self.jobs)
+
+        tasks = {}
+        for step in self.steps:
+            tasks[step] = asyncio.ensure_future(self.runStep(step, tasks))
+
+        await waitAll(list(tasks.values()))
+
+    def run(self):
+        asyncio.run(self.runAsync())
+
+
+async def waitAll(tasks):
+    if not tasks:
+        return
+
+    try:
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+
+    except asyncio.CancelledError:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+    # Cancel everything still in flight on the first failure
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*pending, return_exceptions=True)
+
+    for task in tasks:
+        if task in done and not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+
+def runGraphs(graphs, jobs=None):
+    # Runs several graphs at once, sharing a single job limit
+    async def runAll():
+        semaphore = asyncio.Semaphore(jobs or os.cpu_count() or 1)
+        await waitAll([asyncio.ensure_future(graph.runAsync(semaphore)) for graph in graphs])
+
+    asyncio.run(runAll())
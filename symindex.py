@@ -0,0 +1,96 @@
+# Symbol index - Binary table of the symbols of a linked output, saved next to it
+# Entries are sorted by name and looked up directly in the mapped file,
+# so reusing the index does not require parsing it, or the ELF, again
+
+import mmap, struct
+
+from fileio import atomicFile
+
+
+INDEX_MAGIC = b'CLSI'
+INDEX_VERSION = 1
+
+SECTIONS = ('.text', '.rodata', '.data', '.bss')
+
+headerStruct = struct.Struct('>4sHH32sII')  # Magic, version, padding, key, symbol count, names size
+entryStruct = struct.Struct('>IHBxII')  # Name offset, name length, section, padding, value, size
+
+
+def writeIndex(filename, key, symbols):
+    # symbols: {name: (value, size, section name)}
+    names = bytearray()
+    entries = bytearray()
+    for name in sorted(symbols, key=lambda name: name.encode()):
+        value, size, section = symbols[name]
+        rawname = name.encode()
+        entries += entryStruct.pack(len(names), len(rawname), SECTIONS.index(section), value, size)
+        names += rawname
+
+    header = headerStruct.pack(INDEX_MAGIC, INDEX_VERSION, 0, bytes.fromhex(key), len(symbols), len(names))
+
+    with atomicFile(filename) as f:
+        f.write(header)
+        f.write(entries)
+        f.write(names)
+
+
+class SymbolIndex:
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, _, key, self.count, namesSize = headerStruct.unpack_from(self.map, 0)
+            if magic != INDEX_MAGIC or version != INDEX_VERSION:
+                raise ValueError("Not a symbol index: '%s'" %filename)
+
+            self.key = key.hex()
+            self.namesOffset = headerStruct.size + self.count * entryStruct.size
+            if len(self.map) != self.namesOffset + namesSize:
+                raise ValueError("Truncated symbol index: '%s'" %filename)
+
+        except (ValueError, struct.error):
+            self.map.close()
+            raise
+
+    def close(self):
+        self.map.close()
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, i):
+        nameOff, nameLen, section, value, size = entryStruct.unpack_from(self.map, headerStruct.size + i * entryStruct.size)
+        start = self.namesOffset + nameOff
+        return self.map[start:start + nameLen], (value, size, SECTIONS[section])
+
+    def find(self, name):
+        # Binary search over the sorted names
+        name = name.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.entry(mid)[0] < name:
+                lo = mid + 1
+            else:
+                hi = mid
+
+        if lo < self.count and self.entry(lo)[0] == name:
+            return lo
+
+        return -1
+
+    def get(self, name, default=None):
+        i = self.find(name)
+        if i == -1:
+            return default
+
+        return self.entry(i)[1]
+
+    def __contains__(self, name):
+        return self.find(name) != -1
+
+    def items(self):
+        for i in range(self.count):
+            name, symbol = self.entry(i)
+            yield name.decode(), symbol